@@ -18,27 +18,106 @@ import re
 import yaml
 import collections
 import datetime
+import time
+import contextlib
 import bisect
 import os
 import glob
 import subprocess
+import sys
+import getopt
+import multiprocessing
 from stat import *
 import json
-from collections import namedtuple
-from itertools import groupby
+import mmap
+import hashlib
+import tempfile
+import asyncio
+import concurrent.futures
+import gzip
+import io
+import struct
+from array import array
+from xml.sax.saxutils import escape
 
 
 # In[62]:
 
 
 # Global HG Constants
-HG_NO_PARENT_REV = "-1"
+HG_NO_PARENT_REV = -1
+
+# Locates the revision number field of a change set line produced by the hggraph template
+HG_REV_FIELD = re.compile(r'"rev":"(-?\d+)"')
+HG_REV_FIELD_BYTES = re.compile(rb'"rev":"(-?\d+)"')
 
 
 # In[63]:
 
 
+class Stats(object):
+    """
+    Instrumentation of a run: the wall time of each stage and counters like hg commands run, records parsed and
+    bytes written. The counters are only collected when enabled. report() returns them as a dict, summary() turns
+    a report into text and dump() writes it as JSON.
+    """
+    def __init__(self):
+        self.reset()
+    
+    def reset(self, enabled=False):
+        self.enabled  = enabled
+        self.started  = time.perf_counter()
+        self.stages   = collections.OrderedDict()
+        self.counters = collections.Counter()
+    
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0) + time.perf_counter() - start
+    
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] += n
+    
+    def countCache(self, cache):
+        """
+        Copy the statistics of a CSetCache to the counters, hits as cacheHits and so on.
+        """
+        if self.enabled:
+            for k, v in cache.stats().items():
+                if k != "maxSize":
+                    self.counters["cache" + k[0].upper() + k[1:]] = v
+    
+    def report(self):
+        return {"total": time.perf_counter() - self.started,
+                "stages": dict(self.stages),
+                "counters": dict(self.counters)}
+    
+    @staticmethod
+    def summary(report, title="Run statistics:"):
+        lines = [title, "\t{:<24} {:>10.3f}s".format("total", report["total"])]
+        for name, seconds in report["stages"].items():
+            lines.append("\t{:<24} {:>10.3f}s".format(name, seconds))
+        for name in sorted(report["counters"]):
+            lines.append("\t{:<24} {:>11,}".format(name, report["counters"][name]))
+        return "\n".join(lines)
+    
+    @staticmethod
+    def dump(fileName, report):
+        with open(fileName, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+
+# The statistics of the current run. runIt resets it.
+stats = Stats()
+
+
 class CSet(object):
+    __slots__ = ("branch", "children", "user", "date", "message", "tags", "rev", "node",
+                 "p1node", "p1rev", "p2node", "p2rev")
+    
     def __init__(self, branch="",children="",user="",date="",message="",tags="",rev="", node="", p1node="", p1rev="", p2node="", p2rev=""):
         self.branch   = branch
         self.children = children
@@ -66,49 +145,358 @@ class CSet(object):
         return """{} {} p1={} p2={} c={} {}""".format(self.rev, self.branch, self.p1rev, self.p2rev, self.children, self.tags)
 
 
+class CSetParser(object):
+    """
+    Parses a change set record produced by the hggraph template into a CSet.
+    
+    The fields of the template always come in the same order, so a record is matched by one compiled regular
+    expression instead of json.loads. The message is matched greedily up to the tags field, which lets it contain
+    the double quotes Mercurial doesn't escape. The template doesn't escape anything, so the fields are kept as
+    they are, backslashes included.
+    """
+    recordPattern = re.compile(r'\s*"branch":"(.*?)","children":"(.*?)","user":"(.*?)","date":"(.*?)",'
+                               r'"message":"(.*)","tags":"(.*?)","rev":"(.*?)",\s*"node":"(.*?)",'
+                               r'\s*"p1node":"(.*?)",\s*"p1rev":"(.*?)",\s*"p2node":"(.*?)",\s*"p2rev":"(.*?)"\s*$')
+    
+    @staticmethod
+    def parse(record):
+        stats.count("recordsParsed")
+        m = CSetParser.recordPattern.match(record)
+        if m is None:
+            # Not in the order of the template. Fall back to the generic JSON parser.
+            stats.count("recordsParsedWithJson")
+            c = CSet(**json.loads("{" + record + "}"))
+        else:
+            c = CSet(*m.groups())
+        
+        c.rev, c.p1rev, c.p2rev = int(c.rev), int(c.p1rev), int(c.p2rev)
+        return c
+
+
 # In[64]:
 
 
 class CSetCache(object):
     """
-    Servves as a global variable and cache
+    Cache of CSets keyed by revision number, shared by a HgGraph and its change set source.
+    
+    With maxSize, the least recently used change sets are evicted once the cache holds more than maxSize of them.
+    hits and misses count the lookups, evictions the change sets evicted.
+    
+    The change sets are also indexed by branch, tag, user and node. Nodes can be looked up by a prefix, like the
+    12 digit short hashes in "children", through a sorted list of the nodes which is rebuilt when it's needed
+    after a change.
     """
-    allCsets = dict()
+    def __init__(self, maxSize=None):
+        self.allCsets  = collections.OrderedDict()
+        self.maxSize   = maxSize
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+        
+        self.byBranch = dict() # branch -> {rev: None}, in the order the change sets were added
+        self.byUser   = dict() # user -> {rev: None}
+        self.byTag    = dict() # tag -> rev
+        self.byNode   = dict() # node -> rev
+        self.sortedNodes = None
     
-    @staticmethod
-    def hasRev(rev):
-        try:
-            r = CSetCache.allCsets.get(rev)
-            if r != None:
-                return True
-        except KeyError:
-            pass
-        return False
+    def __len__(self):
+        return len(self.allCsets)
     
-    @staticmethod
-    def add(cset):
-        if CSetCache.hasRev(set):
-            pass
+    def hasRev(self, rev):
+        return rev in self.allCsets
+    
+    def _index(self, cset):
+        self.byBranch.setdefault(cset.branch, dict())[cset.rev] = None
+        self.byUser.setdefault(cset.user, dict())[cset.rev] = None
+        for t in cset.tags.split():
+            self.byTag[t] = cset.rev
+        if cset.node:
+            self.byNode[cset.node] = cset.rev
+            self.sortedNodes = None
+    
+    def _unindex(self, cset):
+        for index, key in ((self.byBranch, cset.branch), (self.byUser, cset.user)):
+            revs = index[key]
+            del revs[cset.rev]
+            if not revs:
+                del index[key]
+        for t in cset.tags.split():
+            if self.byTag.get(t) == cset.rev:
+                del self.byTag[t]
+        if self.byNode.get(cset.node) == cset.rev:
+            del self.byNode[cset.node]
+            self.sortedNodes = None
+    
+    def add(self, cset):
+        if self.hasRev(cset.rev):
+            self.allCsets.move_to_end(cset.rev)
+            return
+        
+        self.allCsets[cset.rev] = cset
+        self._index(cset)
+        if self.maxSize and len(self.allCsets) > self.maxSize:
+            rev, evicted = self.allCsets.popitem(last=False)
+            self._unindex(evicted)
+            self.evictions += 1
+    
+    def _get(self, rev):
+        c = self.allCsets.get(rev) if rev is not None else None
+        if c is None:
+            self.misses += 1
         else:
-            CSetCache.allCsets[cset.rev] = cset
+            self.hits += 1
+            self.allCsets.move_to_end(rev)
+        return c
         
-    @staticmethod
-    def searchCSet(value, attr="rev"):
+    def searchCSet(self, value, attr="rev"):
         """
         By default, it searches for a CSet by revision number. Otherwise, attr parameter is needed to search by
-        other parameters like branch
+        other parameters: branch, user, tags (one tag name) or node (a full node or a prefix of it). Return the
+        first change set found or None.
         """
         if attr == "rev":
-            return CSetCache.allCsets.get(value)
-        for k, v in CSetCache.allCsets.items:
+            return self._get(value)
+        if attr == "node":
+            return self.searchNode(value)
+        if attr == "tags":
+            return self._get(self.byTag.get(value))
+        if attr in ("branch", "user"):
+            revs = (self.byBranch if attr == "branch" else self.byUser).get(value)
+            return self._get(next(iter(revs)) if revs else None)
+        for k, v in self.allCsets.items():
             if getattr(v, attr) == value:
                 return v
         return None
+    
+    def searchNode(self, node):
+        """
+        Return the CSet with the node or the only one whose node starts with it. None if there isn't any or if the
+        prefix is ambiguous.
+        """
+        rev = self.byNode.get(node)
+        if rev is None and node:
+            if self.sortedNodes is None:
+                self.sortedNodes = sorted(self.byNode)
+            i = bisect.bisect_left(self.sortedNodes, node)
+            if i < len(self.sortedNodes) and self.sortedNodes[i].startswith(node):
+                unique = i + 1 == len(self.sortedNodes) or not self.sortedNodes[i + 1].startswith(node)
+                rev = self.byNode[self.sortedNodes[i]] if unique else None
+        return self._get(rev)
+    
+    def branchCSets(self, branch):
+        """
+        Return the CSets of the branch in the cache.
+        """
+        return [self.allCsets[r] for r in self.byBranch.get(branch, ())]
+    
+    def userCSets(self, user):
+        """
+        Return the CSets committed by the user in the cache.
+        """
+        return [self.allCsets[r] for r in self.byUser.get(user, ())]
+    
+    def childrenCSets(self, cset):
+        """
+        Return the CSets of the "rev:node" entries in the children of the change set which are in the cache. The
+        entries are resolved by their short hashes.
+        """
+        children = []
+        for c in cset.children.split():
+            rev, sep, node = c.partition(":")
+            child = self.searchNode(node) if node else self._get(int(rev))
+            if child is not None:
+                children.append(child)
+        return children
+    
+    def replace(self, cset):
+        """
+        Replace the cached change set of the same revision, if there is one, and index it again.
+        """
+        old = self.allCsets.get(cset.rev)
+        if old is None:
+            return
+        self._unindex(old)
+        self.allCsets[cset.rev] = cset
+        self._index(cset)
+    
+    def clear(self):
+        self.allCsets.clear()
+        self.byBranch.clear()
+        self.byUser.clear()
+        self.byTag.clear()
+        self.byNode.clear()
+        self.sortedNodes = None
+    
+    def stats(self):
+        """
+        Return the counters as a dict.
+        """
+        return dict(size=len(self.allCsets), maxSize=self.maxSize, hits=self.hits, misses=self.misses,
+                    evictions=self.evictions)
 
 
 # In[65]:
 
 
+class CSetStore(object):
+    """
+    Array-backed store of change sets keyed by integer revision number.
+    
+    Each change set is one row of parallel int32 arrays: the revision, the parent revisions, the interned branch
+    id and the ids of user, tags and date in a shared string table. The node hash is kept as 20 raw bytes.
+    Children are stored CSR-style: the children of row i are childRevs[childStart[i]:childStart[i+1]]. Children
+    committed after a row was added are kept in extraChildren.
+    The commit message isn't kept because the graph doesn't use it.
+    """
+    def __init__(self):
+        self.revs       = array('i')
+        self.p1         = array('i')
+        self.p2         = array('i')
+        self.branchIds  = array('i')
+        self.userIds    = array('i')
+        self.tagIds     = array('i')
+        self.dateIds    = array('i')
+        self.nodes      = bytearray()
+        self.childStart = array('i', [0])
+        self.childRevs  = array('i')
+        self.extraChildren = dict()
+        
+        self.branchNames = []
+        self.branchIdOf  = dict()
+        self.strings     = [""] # String id 0 is always the empty string
+        self.stringIdOf  = {"": 0}
+        
+        # Rows are usually appended in revision order and are found by binary search. Rows appended out of
+        # order, e.g. parents retrieved later from other branches, are indexed by rowOf.
+        self.sortedRows = 0
+        self.rowOf      = dict()
+    
+    def __len__(self):
+        return len(self.revs)
+    
+    def __contains__(self, rev):
+        return self.row(rev) is not None
+    
+    def _internBranch(self, name):
+        i = self.branchIdOf.get(name)
+        if i is None:
+            i = len(self.branchNames)
+            self.branchNames.append(name)
+            self.branchIdOf[name] = i
+        return i
+    
+    def _internString(self, s):
+        i = self.stringIdOf.get(s)
+        if i is None:
+            i = len(self.strings)
+            self.strings.append(s)
+            self.stringIdOf[s] = i
+        return i
+    
+    def row(self, rev):
+        """
+        Return the row of the revision or None if it's not in the store.
+        """
+        i = bisect.bisect_left(self.revs, rev, 0, self.sortedRows)
+        if i < self.sortedRows and self.revs[i] == rev:
+            return i
+        return self.rowOf.get(rev)
+    
+    def add(self, cset):
+        """
+        Add a CSet to the store if it isn't there yet. Return its row.
+        """
+        row = self.row(cset.rev)
+        if row is not None:
+            return row
+        
+        row = len(self.revs)
+        if row == self.sortedRows and (row == 0 or cset.rev > self.revs[row - 1]):
+            self.sortedRows += 1
+        else:
+            self.rowOf[cset.rev] = row
+        
+        self.revs.append(cset.rev)
+        self.p1.append(cset.p1rev)
+        self.p2.append(cset.p2rev)
+        self.branchIds.append(self._internBranch(cset.branch))
+        self.userIds.append(self._internString(cset.user))
+        self.tagIds.append(self._internString(cset.tags))
+        self.dateIds.append(self._internString(cset.date))
+        try:
+            node = bytes.fromhex(cset.node)
+        except ValueError:
+            node = b""
+        self.nodes += node[:20].ljust(20, b"\0")
+        
+        self.childRevs.extend(Utils.getChildrenRevs(cset))
+        self.childStart.append(len(self.childRevs))
+        return row
+    
+    def update(self, row, cset):
+        """
+        Update the row with a record of its change set read again: its tags and the children it didn't have.
+        Return True if the row has changed.
+        """
+        changed = False
+        tagId = self._internString(cset.tags)
+        if tagId != self.tagIds[row]:
+            self.tagIds[row] = tagId
+            changed = True
+        known = self.children(row)
+        for rev in Utils.getChildrenRevs(cset):
+            if rev not in known:
+                self.addChild(row, rev)
+                changed = True
+        return changed
+    
+    def branchName(self, branchId):
+        return self.branchNames[branchId]
+    
+    def children(self, row):
+        children = self.childRevs[self.childStart[row]:self.childStart[row + 1]]
+        extra = self.extraChildren.get(row)
+        if extra:
+            children.extend(extra)
+        return children
+    
+    def addChild(self, row, rev):
+        """
+        Record a child committed after the row was added.
+        """
+        self.extraChildren.setdefault(row, array('i')).append(rev)
+    
+    def node(self, row):
+        node = self.nodes[row * 20:row * 20 + 20]
+        return node.hex() if any(node) else ""
+    
+    def cset(self, row):
+        """
+        Create a CSet for the row.
+        """
+        children = []
+        for c in self.children(row):
+            r = self.row(c)
+            children.append("{}:{}".format(c, self.node(r)[:12]) if r is not None else str(c))
+        
+        p1, p2 = self.row(self.p1[row]), self.row(self.p2[row])
+        return CSet(branch   = self.branchNames[self.branchIds[row]],
+                    children = " ".join(children),
+                    user     = self.strings[self.userIds[row]],
+                    date     = self.strings[self.dateIds[row]],
+                    tags     = self.strings[self.tagIds[row]],
+                    rev      = self.revs[row],
+                    node     = self.node(row),
+                    p1node   = self.node(p1) if p1 is not None else "",
+                    p1rev    = self.p1[row],
+                    p2node   = self.node(p2) if p2 is not None else "",
+                    p2rev    = self.p2[row])
+
+
+# In[66]:
+
+
 class Utils(object):
     """
     CSet will be used in the following code. It should have the following variables:
@@ -144,13 +532,13 @@ class Utils(object):
 
     @staticmethod
     def createGraphVizNodeName(cset):
-        return "r" + cset.rev
+        return "r{}".format(cset.rev)
     
     @staticmethod
-    def getBranchChildren(cset, branch):
+    def getBranchChildren(cset, branch, cache):
         cl = []
-        for c in cset.children.split(" "):
-            d = CSetCache.searchCSet(c.split(":")[0])
+        for c in Utils.getChildrenRevs(cset):
+            d = cache.searchCSet(c)
 
             # We don't want the child in the same branch
             if d.branch != branch:
@@ -158,14 +546,14 @@ class Utils(object):
         return cl 
 
     @staticmethod
-    def getBranchParent(cset, branch):
-        p = CSetCache.searchCSet(cset.p2rev)
+    def getBranchParent(cset, branch, cache):
+        p = cache.searchCSet(cset.p2rev)
 
         # We don't want the parent in the same branch
         if p.branch != branch:
             return p
         
-        p = CSetCache.searchCSet(cset.p1rev)
+        p = cache.searchCSet(cset.p1rev)
 
         # We don't want the parent in the same branch
         if p.branch != branch:
@@ -179,7 +567,7 @@ class Utils(object):
 
         l = []
         for c in cset.children.split(" "):
-            l.append(c.split(":")[0])
+            l.append(int(c.split(":")[0]))
         return l
     
     @staticmethod
@@ -195,22 +583,26 @@ class Utils(object):
     def createGraphVizNode(type, cset, tagName, shape, style, fillcolor, fontcolor):
         tagTemp = '''{name} [label="{label}" fontcolor={fontcolor} style="{style}" fillcolor={fillcolor} shape={shape}];'''
 
-        name = "r" + cset.rev
-        dt   = cset.date.split(" ")[0]
+        name = "r{}".format(cset.rev)
+        label = "\\n".join(Utils.createNodeLabel(type, cset, tagName))
+        return tagTemp.format(name=name, label=label, fontcolor=fontcolor, style=style, fillcolor=fillcolor, shape=shape)
 
-        s = ""
+    @staticmethod
+    def createNodeLabel(type, cset, tagName):
+        """
+        Return the lines of the label of a node.
+        """
+        dt = cset.date.split(" ")[0]
         if cset.tags or type == "LEAF":
-            label= """{}\\n{}\\n{}""".format(tagName, dt, cset.rev)
+            return [tagName, dt, str(cset.rev)]
         elif type == "TIP":
-            label = "tip"
+            return ["tip"]
         elif type == "TAIL":
-            label = """{}\\n{}""".format(tagName, cset.rev)
-        else:
-            label = """{}\\n{}""".format(dt, cset.rev)
-        return tagTemp.format(name=name, label=label, fontcolor=fontcolor, style=style, fillcolor=fillcolor, shape=shape)
+            return [tagName, str(cset.rev)]
+        return [dt, str(cset.rev)]
 
 
-# In[66]:
+# In[67]:
 
 
 class CSetDebug(object):
@@ -219,20 +611,40 @@ class CSetDebug(object):
         self.hgCmd = hgCmd
     
     def retrieveCSet(self, rev):
-        me = CSetCache.searchCSet(rev)
+        me = self.hgCmd.cache.searchCSet(rev)
         if me == None:
             me = self.hgCmd.getCSetFromRepo(rev)
             if me == None:
                 return None
         return me
     
+    def showByNode(self, node):
+        """
+        Show the change set with the node, which can be a short hash, if it is in the cache.
+        """
+        me = self.hgCmd.cache.searchNode(node)
+        if me == None:
+            print("Unknown or ambiguous node: {}".format(node))
+            return
+        self.showByRev(me.rev)
+    
+    def showByTag(self, tag):
+        """
+        Show the tagged change set if it is in the cache.
+        """
+        me = self.hgCmd.cache.searchCSet(tag, "tags")
+        if me == None:
+            print("Unknown tag: {}".format(tag))
+            return
+        self.showByRev(me.rev)
+    
     def formatCSet(self, c):
         if c == None:
             return "None"
         return "br={} rev={} p1={} p2={} c={}".format(c.branch, c.rev, c.p1rev, c.p2rev, c.children)
     
     def showByRev(self, rev):
-        me = self.retrieveCSet(rev)
+        me = self.retrieveCSet(int(rev))
         if me == None:
             print("Wrong revision number: {}".format(rev))
             return
@@ -246,77 +658,1040 @@ class CSetDebug(object):
             print("\t{}".format(self.formatCSet(self.retrieveCSet(p))))
 
 
-# In[67]:
+# In[68]:
+
+
+class BranchQuery(object):
+    """
+    Filters change set records with the hgquery. The query is compiled once and matched against the branch field
+    of a record only, and the whole buffer (a string or a memory-mapped file) is scanned in one pass.
+    """
+    recordPattern      = re.compile(r'^[ \t]*"branch":"(.*?)","children":.*$', re.M)
+    recordPatternBytes = re.compile(rb'^[ \t]*"branch":"(.*?)","children":.*$', re.M)
+    
+    def __init__(self, queryStr):
+        if isinstance(queryStr, (list, tuple)): # Several release lines, see HgCommand
+            queryStr = "|".join("(?:{})".format(q) for q in queryStr)
+        self.query = re.compile(queryStr)
+        self.matchedBranches = dict() # There are only a few distinct branches. Remember the result for each.
+        
+    def matches(self, branch):
+        m = self.matchedBranches.get(branch)
+        if m is None:
+            m = self.query.search(branch) is not None
+            self.matchedBranches[branch] = m
+        return m
+    
+    def spans(self, buffer):
+        """
+        Generator yielding (start, end) of each record in the buffer whose branch satisfies the query.
+        """
+        if isinstance(buffer, str):
+            for m in BranchQuery.recordPattern.finditer(buffer):
+                if self.matches(m.group(1)):
+                    yield m.span()
+        else:
+            for m in BranchQuery.recordPatternBytes.finditer(buffer):
+                if self.matches(m.group(1).decode("utf-8")):
+                    yield m.span()
+    
+    def records(self, text):
+        """
+        Return the list of records in the text whose branch satisfies the query.
+        """
+        return [text[a:b].strip() for a, b in self.spans(text)]
+    
+    def rows(self, lines):
+        """
+        Return an array of the indexes of the lines whose branch satisfies the query.
+        """
+        rows = array('l')
+        for i, l in enumerate(lines):
+            m = BranchQuery.recordPattern.match(l)
+            if m and self.matches(m.group(1)):
+                rows.append(i)
+        return rows
+
+
+# In[69]:
+
+
+class CSetDiskCache(object):
+    """
+    On-disk cache of all the change sets of a repository, kept between runs.
+    
+    The change sets are stored in the csetFile format, one record per line, in <key>.csets. The file is only
+    appended to: a record written later replaces an earlier record of the same revision. <key>.json records the
+    repository and the revision and node hash of the cached tip, which are used to detect a stripped repository.
+    """
+    tagsField = re.compile(r'"tags":"(.*?)","rev"')
+
+    def __init__(self, cacheDir, repositoryDir):
+        self.repo = os.path.abspath(repositoryDir)
+        key = hashlib.sha1(self.repo.encode("utf-8")).hexdigest()[:16]
+        self.dataFile = os.path.join(cacheDir, key + ".csets")
+        self.metaFile = os.path.join(cacheDir, key + ".json")
+        
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+    
+    def load(self):
+        """
+        Return the cache metadata, a dict with repo, tipRev, tipNode and lines, or None if there is no valid cache.
+        """
+        try:
+            with open(self.metaFile, 'r') as f:
+                meta = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if meta.get("repo") != self.repo or not os.path.exists(self.dataFile):
+            return None
+        return meta
+    
+    def clear(self):
+        for fn in (self.metaFile, self.dataFile):
+            if os.path.exists(fn):
+                os.remove(fn)
+    
+    def readLines(self):
+        with open(self.dataFile, 'r', encoding='utf-8') as f:
+            return [l.strip() for l in f if l.strip()]
+    
+    def index(self, lines=None):
+        """
+        Return the cached records, or lines, keyed by revision number. The latest record of a revision wins.
+        """
+        index = dict()
+        for l in (lines if lines is not None else self.readLines()):
+            m = HG_REV_FIELD.search(l)
+            if m:
+                index[int(m.group(1))] = l
+        return index
+    
+    def write(self, lines, tipRev, tipNode, append=True):
+        """
+        Append the records to the cache (or replace it if append is False) and record the new tip.
+        """
+        meta = self.load() if append else None
+        count = meta["lines"] if meta else 0
+        
+        with open(self.dataFile, 'a' if append else 'w', encoding='utf-8') as f:
+            for l in lines:
+                f.write(l + "\n")
+        
+        # Write the metadata last so that an interrupted run leaves the old tip behind and is refetched
+        meta = {"repo": self.repo, "tipRev": tipRev, "tipNode": tipNode, "lines": count + len(lines)}
+        tmp = self.metaFile + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, self.metaFile)
+    
+    def compact(self, lines, tipRev, tipNode):
+        """
+        Rewrite the cache with one record per revision.
+        """
+        self.write(lines, tipRev, tipNode, append=False)
+
+
+class CSetSnapshot(object):
+    """
+    Binary snapshot of a csetFile. It is memory-mapped and served without parsing the records.
+    
+    All the numbers are little-endian. The file starts with a header: the magic b"HGGSNAP\\0", the format version,
+    the number of change sets, strings and children, and the offsets of the sections below and of the end of the
+    file. Each section starts at a multiple of 8 bytes.
+        
+        records        one row of len(FIELDS) int32 per change set, in the order of the csetFile. rev, p1rev and
+                       p2rev are revisions, the other fields are ids in the string table, or -1 if the value is
+                       kept in the nodes or children sections
+        sortedRevs     the revisions in ascending order, int32
+        sortedRows     the row of each of them, int32
+        nodes          node, p1node and p2node of each row, 20 raw bytes each
+        childStart     the children of row i are childStart[i]:childStart[i+1] of childRevs and childNodes, int32
+        childRevs      the revision of each child, int32
+        childNodes     the short node hash of each child, 6 raw bytes
+        stringOffsets  the start of each string in stringData and the end of the last one, int64
+        stringData     the UTF-8 strings, each stored once
+    
+    Node hashes and children in the format of the hggraph template are kept as raw bytes, anything else is kept
+    as a string, so every record reads back exactly as CSetParser parsed it.
+    """
+    MAGIC    = b"HGGSNAP\0"
+    VERSION  = 1
+    FIELDS   = ("rev", "p1rev", "p2rev", "branch", "children", "user", "date", "message", "tags",
+                "node", "p1node", "p2node")
+    SECTIONS = ("records", "sortedRevs", "sortedRows", "nodes", "childStart", "childRevs", "childNodes",
+                "stringOffsets", "stringData")
+    header   = struct.Struct("<8sIIII{}Q".format(len(SECTIONS) + 1))
+    
+    hexNode     = re.compile(r'[0-9a-f]{40}\Z')
+    hexChildren = re.compile(r'(-?\d+:[0-9a-f]{12})( -?\d+:[0-9a-f]{12})*\Z')
+    
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.mm       = None
+        self.count    = 0
+        self.sections = dict()
+        self.branchNames = dict() # Branch names are decoded once per string id
+    
+    def __len__(self):
+        return self.count
+    
+    @staticmethod
+    def isSnapshot(fileName):
+        try:
+            with open(fileName, 'rb') as f:
+                return f.read(len(CSetSnapshot.MAGIC)) == CSetSnapshot.MAGIC
+        except IOError:
+            return False
+    
+    @staticmethod
+    def write(lines, fileName):
+        """
+        Convert csetFile records to a snapshot in fileName. Return the number of change sets written.
+        """
+        width = len(CSetSnapshot.FIELDS)
+        strings, stringIdOf = [], dict()
+        def stringId(s):
+            i = stringIdOf.get(s)
+            if i is None:
+                i = len(strings)
+                strings.append(s)
+                stringIdOf[s] = i
+            return i
+        
+        records    = array('i')
+        nodes      = bytearray()
+        childStart = array('i', [0])
+        childRevs  = array('i')
+        childNodes = bytearray()
+        for l in lines:
+            c = CSetParser.parse(l)
+            records.extend((c.rev, c.p1rev, c.p2rev, stringId(c.branch)))
+            if CSetSnapshot.hexChildren.match(c.children) or c.children == "":
+                records.append(-1)
+                for child in c.children.split():
+                    rev, node = child.split(":")
+                    childRevs.append(int(rev))
+                    childNodes += bytes.fromhex(node)
+            else:
+                records.append(stringId(c.children))
+            childStart.append(len(childRevs))
+            records.extend((stringId(c.user), stringId(c.date), stringId(c.message), stringId(c.tags)))
+            for node in (c.node, c.p1node, c.p2node):
+                if CSetSnapshot.hexNode.match(node):
+                    records.append(-1)
+                    nodes += bytes.fromhex(node)
+                else:
+                    records.append(stringId(node))
+                    nodes += bytes(20)
+        
+        count = len(records) // width
+        sortedRows = array('i', sorted(range(count), key=lambda row: records[row * width]))
+        sortedRevs = array('i', (records[row * width] for row in sortedRows))
+        
+        stringData    = bytearray()
+        stringOffsets = array('q', [0])
+        for s in strings:
+            stringData += s.encode("utf-8")
+            stringOffsets.append(len(stringData))
+        
+        # Write to a temporary file first so that a reader never maps a half written snapshot
+        offsets = []
+        tmp = fileName + ".tmp"
+        with open(tmp, 'wb') as f:
+            f.write(bytes(CSetSnapshot.header.size))
+            for s in (records, sortedRevs, sortedRows, nodes, childStart, childRevs, childNodes, stringOffsets, stringData):
+                f.write(bytes(-f.tell() % 8))
+                offsets.append(f.tell())
+                if isinstance(s, array) and sys.byteorder != "little":
+                    s = array(s.typecode, s)
+                    s.byteswap()
+                f.write(s)
+            offsets.append(f.tell())
+            f.seek(0)
+            f.write(CSetSnapshot.header.pack(CSetSnapshot.MAGIC, CSetSnapshot.VERSION, count, len(strings),
+                                             len(childRevs), *offsets))
+        os.replace(tmp, fileName)
+        return count
+    
+    def open(self):
+        """
+        Map the snapshot. Return False if it isn't a valid snapshot of the supported version.
+        """
+        self.close()
+        try:
+            with open(self.fileName, 'rb') as f:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, ValueError): # Empty file can't be mapped
+            print("\nThere are errors opening file {}".format(self.fileName))
+            return False
+        
+        if len(self.mm) < CSetSnapshot.header.size or self.mm[:len(CSetSnapshot.MAGIC)] != CSetSnapshot.MAGIC:
+            print("\n{} is not a change set snapshot".format(self.fileName))
+            self.close()
+            return False
+        header = CSetSnapshot.header.unpack_from(self.mm)
+        version, count, stringCount, childCount = header[1:5]
+        offsets = header[5:]
+        if version != CSetSnapshot.VERSION:
+            print("\nThe snapshot {} has version {} but version {} is expected. Please convert the csetFile again.".format(
+                  self.fileName, version, CSetSnapshot.VERSION))
+            self.close()
+            return False
+        
+        sizes = {"records": count * len(CSetSnapshot.FIELDS) * 4, "sortedRevs": count * 4, "sortedRows": count * 4,
+                 "nodes": count * 60, "childStart": (count + 1) * 4, "childRevs": childCount * 4,
+                 "childNodes": childCount * 6, "stringOffsets": (stringCount + 1) * 8,
+                 "stringData": offsets[-1] - offsets[-2]}
+        if offsets[-1] != len(self.mm) or any(offsets[i] + sizes[s] > offsets[i + 1] for i, s in enumerate(CSetSnapshot.SECTIONS)):
+            print("\nThe snapshot {} is truncated".format(self.fileName))
+            self.close()
+            return False
+        
+        view = memoryview(self.mm)
+        for i, s in enumerate(CSetSnapshot.SECTIONS):
+            section = view[offsets[i]:offsets[i] + sizes[s]]
+            typecode = {"stringOffsets": 'q', "nodes": None, "childNodes": None, "stringData": None}.get(s, 'i')
+            if typecode is None:
+                self.sections[s] = section
+            elif sys.byteorder == "little":
+                self.sections[s] = section.cast(typecode)
+            else:
+                self.sections[s] = array(typecode, section.tobytes())
+                self.sections[s].byteswap()
+        view.release()
+        self.count = count
+        return True
+    
+    def close(self):
+        # The views must be released before the map can be closed
+        for s in self.sections.values():
+            if isinstance(s, memoryview):
+                s.release()
+        self.sections = dict()
+        self.branchNames = dict()
+        self.count = 0
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+    
+    def string(self, i):
+        offsets = self.sections["stringOffsets"]
+        return str(self.sections["stringData"][offsets[i]:offsets[i + 1]], "utf-8")
+    
+    def branchName(self, row):
+        i = self.sections["records"][row * len(CSetSnapshot.FIELDS) + 3]
+        name = self.branchNames.get(i)
+        if name is None:
+            name = self.string(i)
+            self.branchNames[i] = name
+        return name
+    
+    def row(self, rev):
+        """
+        Return the row of the revision or None if it's not in the snapshot.
+        """
+        revs = self.sections["sortedRevs"]
+        i = bisect.bisect_left(revs, rev)
+        if i < len(revs) and revs[i] == rev:
+            return self.sections["sortedRows"][i]
+        return None
+    
+    def cset(self, row):
+        """
+        Create a CSet for the row.
+        """
+        rev, p1rev, p2rev, branch, children, user, date, message, tags, node, p1node, p2node = \
+            self.sections["records"][row * len(CSetSnapshot.FIELDS):(row + 1) * len(CSetSnapshot.FIELDS)]
+        
+        if children < 0:
+            revs, hashes = self.sections["childRevs"], self.sections["childNodes"]
+            children = " ".join("{}:{}".format(revs[i], hashes[i * 6:i * 6 + 6].hex())
+                                for i in range(self.sections["childStart"][row], self.sections["childStart"][row + 1]))
+        else:
+            children = self.string(children)
+        
+        nodes = self.sections["nodes"]
+        node, p1node, p2node = [self.string(n) if n >= 0 else nodes[row * 60 + k * 20:row * 60 + k * 20 + 20].hex()
+                                for k, n in enumerate((node, p1node, p2node))]
+        return CSet(branch   = self.branchName(row),
+                    children = children,
+                    user     = self.string(user),
+                    date     = self.string(date),
+                    message  = self.string(message),
+                    tags     = self.string(tags),
+                    rev      = rev,
+                    node     = node,
+                    p1node   = p1node,
+                    p1rev    = p1rev,
+                    p2node   = p2node,
+                    p2rev    = p2rev)
+
+
+class RenderCache(object):
+    """
+    Content-addressed cache of the images rendered from DOT files, kept between runs.
+    
+    An image is stored as <key>.<format> where the key hashes the DOT source together with the renderer command and
+    options, so the same graph is only rendered once. Reading an image updates its modification time. Once the
+    images take more than maxBytes, the least recently used ones are removed.
+    """
+    def __init__(self, cacheDir, maxBytes=512 * 1024 * 1024):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.hits     = 0
+        self.misses   = 0
+        
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+    
+    @staticmethod
+    def key(source, command, format, options):
+        h = hashlib.sha256(json.dumps([command, format, options]).encode("utf-8"))
+        h.update(source)
+        return h.hexdigest()
+    
+    def _path(self, key, format):
+        return os.path.join(self.cacheDir, "{}.{}".format(key, format))
+    
+    def get(self, key, format):
+        """
+        Return the cached image or None.
+        """
+        fileName = self._path(key, format)
+        try:
+            with open(fileName, 'rb') as f:
+                data = f.read()
+            os.utime(fileName)
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+    
+    def put(self, key, format, data):
+        fileName = self._path(key, format)
+        tmp = "{}.{}.tmp".format(fileName, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, fileName)
+        self.evict(keep=fileName)
+    
+    def evict(self, keep=None):
+        """
+        Remove the least recently used images until the cache takes at most maxBytes. keep is never removed.
+        """
+        files = []
+        for fn in glob.glob(os.path.join(self.cacheDir, "*.*")):
+            try:
+                st = os.stat(fn)
+            except OSError:
+                continue # Removed by another process
+            files.append((st.st_mtime, st.st_size, fn))
+        
+        total = sum(f[1] for f in files)
+        for mtime, size, fn in sorted(files):
+            if total <= self.maxBytes:
+                break
+            if fn == keep:
+                continue
+            try:
+                os.remove(fn)
+            except OSError:
+                pass
+            total -= size
+
+
+# In[70]:
+
+
+class HgCommandError(Exception):
+    """
+    A hg command failed: it wrote to the standard error output, exited with an error or timed out, or hg or the
+    Mercurial command server couldn't be run. revset is None if the failure isn't about a query.
+    """
+    def __init__(self, revset, message, returncode=None):
+        super(HgCommandError, self).__init__(message if revset is None else "hg log -r \"{}\": {}".format(revset, message))
+        self.revset = revset
+        self.message = message
+        self.returncode = returncode
+    
+    @staticmethod
+    def fromOutput(revset, stderr, returncode):
+        if isinstance(stderr, bytes):
+            stderr = stderr.decode("utf-8", "replace")
+        return HgCommandError(revset, stderr.strip() or "hg log exited with {}".format(returncode), returncode)
+
+
+class HgQueryRunner(object):
+    """
+    Runs hg log queries concurrently with asyncio, at most concurrency hg processes at a time. A query which runs
+    longer than timeout seconds is killed. No timeout if it's 0 or None.
+    """
+    def __init__(self, concurrency=4, timeout=None):
+        self.concurrency = max(concurrency or 1, 1)
+        self.timeout = timeout or None
+    
+    async def _log(self, semaphore, repo, revset, template):
+        async with semaphore:
+            stats.count("hgCommands")
+            stats.count("hgProcesses")
+            try:
+                proc = await asyncio.create_subprocess_exec("hg", "log", '-r', revset, "--template", template, cwd=repo,
+                                                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=os.environ)
+            except OSError as e: # hg isn't installed or the repository doesn't exist
+                raise HgCommandError(revset, str(e))
+            try:
+                stdout, stderr = await asyncio.wait_for(proc.communicate(), self.timeout)
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+                raise HgCommandError(revset, "timed out after {} seconds".format(self.timeout))
+        
+        stats.count("hgBytesRead", len(stdout))
+        if stderr or proc.returncode != 0:
+            raise HgCommandError.fromOutput(revset, stderr, proc.returncode)
+        return stdout.decode("utf-8")
+    
+    async def _logAll(self, queries):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        return await asyncio.gather(*[self._log(semaphore, *q) for q in queries], return_exceptions=True)
+    
+    def run(self, queries):
+        """
+        Run the queries, a list of (repository, revset, template). Return a list with the output of each query, or
+        the HgCommandError it failed with, in the order of the queries.
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            results = asyncio.run(self._logAll(queries))
+        else:
+            # Called from a running event loop, e.g. in Jupyter or IPython. asyncio.run can't nest, so the queries
+            # get a loop of their own in a worker thread.
+            with concurrent.futures.ThreadPoolExecutor(1) as executor:
+                results = executor.submit(asyncio.run, self._logAll(queries)).result()
+        for r in results:
+            if isinstance(r, BaseException) and not isinstance(r, HgCommandError):
+                raise r
+        return results
+
+
+class HgCmdServer(object):
+    """
+    Client of the Mercurial command server (hg serve --cmdserver pipe).
+    
+    One hg process is kept alive and commands are sent to it over its pipes, so they don't pay the start up cost of
+    hg. Messages from the server are a channel byte, a big-endian 32 bits length and the data. A command is sent as
+    "runcommand\n", the length and the arguments separated by NUL. The server answers with output ('o') and error
+    ('e') messages and ends with the return code on the result channel ('r').
+    """
+    command = ["hg", "serve", "--cmdserver", "pipe", "--config", "ui.interactive=False"]
+    
+    def __init__(self, repositoryDir, command=None):
+        self.repo = repositoryDir
+        self.command = command or HgCmdServer.command
+        self.proc = None
+        self.capabilities = []
+        self.encoding = "UTF-8"
+        
+    def _readMessage(self):
+        header = self.proc.stdout.read(5)
+        if len(header) < 5:
+            self.close()
+            raise HgCommandError(None, "Mercurial command server has stopped")
+        channel, length = struct.unpack(">cI", header)
+        if channel in (b"I", b"L"): # Input requests carry the requested size and no data
+            return channel, length
+        return channel, self.proc.stdout.read(length)
+    
+    def start(self):
+        env = dict(os.environ, HGPLAIN="1", HGENCODING="UTF-8")
+        stats.count("hgProcesses")
+        try:
+            self.proc = subprocess.Popen(self.command, cwd=self.repo, env=env,
+                                         stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        except OSError as e: # hg isn't installed or the repository doesn't exist
+            raise HgCommandError(None, "Mercurial command server can't be started: {}".format(e))
+        channel, hello = self._readMessage()
+        if channel != b"o":
+            self.close()
+            raise HgCommandError(None, "Unexpected hello message from Mercurial command server")
+        
+        for l in hello.decode("ascii").split("\n"):
+            k, _, v = l.partition(": ")
+            if k == "capabilities":
+                self.capabilities = v.split()
+            elif k == "encoding":
+                self.encoding = v
+        if "runcommand" not in self.capabilities:
+            self.close()
+            raise HgCommandError(None, "Mercurial command server doesn't support runcommand")
+    
+    def runCommand(self, args):
+        """
+        Run a hg command, e.g. ["log", "-r", "tip"]. Return a tuple of the return code, standard output and standard
+        error output.
+        """
+        out, err = [], []
+        for channel, data in self.messages(args):
+            if channel == b"o":
+                out.append(data)
+            elif channel == b"e":
+                err.append(data)
+            else:
+                stats.count("hgBytesRead", sum(len(o) for o in out))
+                return struct.unpack(">i", data)[0], b"".join(out), b"".join(err)
+    
+    def messages(self, args):
+        """
+        Run a hg command and yield its output ('o'), error ('e') and result ('r') messages as (channel, data) as they
+        arrive. The result message comes last. The generator must be exhausted before the next command is sent.
+        """
+        if self.proc is None:
+            self.start()
+        
+        data = b"\0".join(a.encode(self.encoding) for a in args)
+        try:
+            self.proc.stdin.write(b"runcommand\n" + struct.pack(">I", len(data)) + data)
+            self.proc.stdin.flush()
+        except OSError as e: # The server has stopped
+            self.close()
+            raise HgCommandError(None, "Mercurial command server has stopped: {}".format(e))
+        
+        while True:
+            channel, data = self._readMessage()
+            if channel in (b"o", b"e"):
+                yield channel, data
+            elif channel == b"r":
+                yield channel, data
+                return
+            elif channel in (b"I", b"L"):
+                self.proc.stdin.write(struct.pack(">I", 0)) # hg log never needs any input
+                self.proc.stdin.flush()
+            elif channel.isupper():
+                self.close()
+                raise HgCommandError(None, "Unexpected required channel {} from Mercurial command server".format(channel))
+    
+    def close(self):
+        if self.proc is not None:
+            self.proc.stdin.close()
+            self.proc.stdout.close() # Unread output of an abandoned command mustn't block the server
+            self.proc.wait()
+            self.proc = None
+
+
+# In[71]:
 
 
 class HgCommand(object):
-    def __init__(self, repositoryDir, queryStr):
+    # The size of the blocks read from the hg log output in streaming mode
+    streamBlockSize = 64 * 1024
+    
+    def __init__(self, repositoryDir, queryStr, prefetch=True, cacheDir=None, backend="process",
+                 since=None, until=None, revs=None, sinceTag=None, cache=None, streaming=False, concurrency=4, timeout=None):
         self.repo = repositoryDir
-        self.query = "branch('re:{}')".format(queryStr) # for HG command
+        self.cache = cache if cache is not None else CSetCache() # The change sets retrieved by getCSetFromRepo
+        self.query = HgCommand.buildQuery(queryStr, since, until, revs, sinceTag) # for HG command
+        
+        # queryStr can be a list of branch regexes, e.g. one per release line. Each one is a query of its own and
+        # the queries run concurrently (see HgQueryRunner). query is their union.
+        self.queries = [HgCommand.buildQuery(q, since, until, revs, sinceTag)
+                        for q in (queryStr if isinstance(queryStr, (list, tuple)) else [queryStr])]
+        self.runner = HgQueryRunner(concurrency, timeout)
+        self.windowed = bool(since or until or revs or sinceTag)
         self.queryStr = queryStr
+        self.branchQuery = BranchQuery(queryStr)
         self.current = 0
         self.lines = []
+        self.records = []
+        
+        # Records of the queried change sets and of their parents and children in other branches, keyed by
+        # revision number. The neighbours are prefetched by run() in one hg call, so getCSetFromRepo rarely
+        # needs to start another hg process.
+        self.prefetch = prefetch
+        self.revIndex = dict()
+        self.missingRevs = set()
+        
+        # With a cache directory, all the change sets of the repository are kept in a CSetDiskCache and each run
+        # only retrieves the change sets committed since the previous run.
+        self.diskCache = CSetDiskCache(cacheDir, repositoryDir) if cacheDir else None
+        
+        # hg commands run in a new hg process each time, or in one Mercurial command server with backend "cmdserver"
+        self.cmdServer = HgCmdServer(repositoryDir) if backend == "cmdserver" else None
+        
+        # In streaming mode the records are parsed as hg outputs them and iterating over the HgCommand yields them
+        # while hg is still running, see _streamCSets. The output isn't kept. It doesn't apply to the disk cache.
+        self.streaming = streaming and not cacheDir
+        self.stream = None
+        self.first  = None
+        self.streamErrors = []
         
         # Hg template. Not be changeable by user
         self.template = '"branch":"{branch}","children":"{children}","user":"{author}","date":"{date|isodate}","message":"{firstline(desc)}","tags":"{tags}","rev":"{rev}", "node":"{node}", "p1node":"{p1node}", "p1rev":"{p1rev}", "p2node":"{p2node}", "p2rev":"{p2rev}"\n'
 
+    @staticmethod
+    def buildQuery(queryStr, since=None, until=None, revs=None, sinceTag=None):
+        """
+        Build the revset of the change sets of the graph. The branches are selected by queryStr, a regex or a list of
+        regexes. They can be narrowed down to a window so that hg only outputs the change sets we need:
+        - since, until: dates in any format hg accepts, e.g. "2015-06-01"
+        - revs: a revision range or any other revset, e.g. "30000:" or "30000:30500"
+        - sinceTag: the change sets committed since the tag, i.e. from the tagged revision on
+        """
+        if isinstance(queryStr, (list, tuple)):
+            return " or ".join("({})".format(HgCommand.buildQuery(q, since, until, revs, sinceTag)) for q in queryStr)
+        
+        quote = lambda s: "'{}'".format(str(s).replace("\\", "\\\\").replace("'", "\\'"))
+        
+        query = "branch('re:{}')".format(queryStr)
+        if since and until:
+            query += " and date({})".format(quote("{} to {}".format(since, until)))
+        elif since:
+            query += " and date({})".format(quote(">{}".format(since)))
+        elif until:
+            query += " and date({})".format(quote("<{}".format(until)))
+        if revs:
+            query += " and ({})".format(revs)
+        if sinceTag:
+            query += " and (tag({}):)".format(quote(sinceTag))
+        return query
+    
+    def _hgLogs(self, revsets, template=None):
+        """
+        Run hg log with the hggraph template for each revset. The hg processes run concurrently, the command server
+        runs the queries one after the other. Return a list with the output of each revset or the HgCommandError
+        it failed with.
+        """
+        if not self.cmdServer:
+            return self.runner.run([(self.repo, r, template or self.template) for r in revsets])
+        
+        results = []
+        for revset in revsets:
+            stats.count("hgCommands")
+            ret, stdoutId, stderrId = self.cmdServer.runCommand(["log", '-r', revset, "--template", template or self.template])
+            if ret != 0 or stderrId:
+                results.append(HgCommandError.fromOutput(revset, stderrId, ret))
+            else:
+                results.append(stdoutId.decode("utf-8"))
+        return results
+    
+    def _hgLog(self, revset, template=None):
+        """
+        Run hg log with the hggraph template. Return the standard output. Raise HgCommandError if hg fails.
+        """
+        result = self._hgLogs([revset], template)[0]
+        if isinstance(result, HgCommandError):
+            raise result
+        return result
+    
+    def _hgLogStream(self, revset, errors):
+        """
+        Run hg log with the hggraph template and yield the lines of its standard output as they arrive. The standard
+        error output is appended to errors once hg has finished.
+        """
+        stats.count("hgCommands")
+        args = ["log", '-r', revset, "--template", self.template]
+        if self.cmdServer:
+            def blocks():
+                for channel, data in self.cmdServer.messages(args):
+                    if channel == b"o":
+                        yield data
+                    elif channel == b"e":
+                        errors.append(data)
+                    elif struct.unpack(">i", data)[0] != 0 and not errors:
+                        errors.append("hg log exited with {}".format(struct.unpack(">i", data)[0]).encode("utf-8"))
+        else:
+            # The error output goes to a file because a full stderr pipe would block hg while we read stdout
+            stats.count("hgProcesses")
+            stderr = tempfile.TemporaryFile()
+            try:
+                proc = subprocess.Popen(["hg"] + args, cwd=self.repo, stdout=subprocess.PIPE, stderr=stderr, env=os.environ)
+            except OSError as e:
+                stderr.close()
+                raise HgCommandError(revset, str(e))
+            def blocks():
+                try:
+                    for data in iter(lambda: proc.stdout.read1(HgCommand.streamBlockSize), b""):
+                        yield data
+                finally:
+                    proc.stdout.close() # Stops hg if the stream is closed before the end
+                    proc.wait()
+                    stderr.seek(0)
+                    err = stderr.read()
+                    stderr.close()
+                    if err:
+                        errors.append(err)
+        
+        rest = b""
+        for data in blocks():
+            stats.count("hgBytesRead", len(data))
+            lines = (rest + data).split(b"\n")
+            rest = lines.pop()
+            for l in lines:
+                yield l.decode("utf-8")
+        if rest:
+            yield rest.decode("utf-8")
+    
+    def _streamCSets(self):
+        """
+        Generator yielding the queried change sets while hg outputs them. The neighbours in other branches are
+        prefetched once the output is complete.
+        """
+        for l in self._hgLogStream(self.query, self.streamErrors):
+            m = BranchQuery.recordPattern.match(l)
+            if m and self.branchQuery.matches(m.group(1)):
+                yield CSetParser.parse(l.strip())
+        
+        if self.streamErrors:
+            raise HgCommandError.fromOutput(self.query, b"".join(self.streamErrors), None)
+        if self.prefetch:
+            self._prefetchClosure()
+    
+    def _iterStream(self, first):
+        yield first
+        for c in self.stream:
+            yield c
+    
+    def _indexLines(self, lines):
+        for l in lines:
+            m = HG_REV_FIELD.search(l)
+            if m:
+                self.revIndex.setdefault(int(m.group(1)), l)
+    
+    def _closureQuery(self):
+        return "(parents({q}) or children({q})) and not ({q})".format(q=self.query)
+    
+    def _prefetchClosure(self):
+        """
+        Retrieve the parents and children of the queried change sets which are not in the query, i.e., the
+        change sets in other branches the graph links to.
+        """
+        try:
+            text = self._hgLog(self._closureQuery())
+        except HgCommandError:
+            return # Not fatal. getCSetFromRepo will retrieve them one by one.
+        self._indexLines(text.strip().split("\n"))
+    
+    def _updateDiskCache(self):
+        """
+        Bring the disk cache up to date with the repository. Raise HgCommandError if hg fails.
+        """
+        meta = self.diskCache.load()
+        revset = "{} + tip".format(meta["tipRev"]) if meta else "tip"
+        try:
+            text = self._hgLog(revset, "{rev} {node}\n")
+        except HgCommandError:
+            if not meta:
+                raise
+            # The cached tip doesn't exist anymore, e.g. the repository has been stripped. Start over.
+            meta = None
+            text = self._hgLog("tip", "{rev} {node}\n")
+        
+        nodes = dict()
+        for l in text.strip().split("\n"):
+            rev, node = l.split(" ")
+            nodes[int(rev)] = node
+        tipRev = max(nodes)
+        
+        if meta and nodes.get(meta["tipRev"]) != meta["tipNode"]:
+            meta = None # Same revision number but a different change set. The history has been rewritten.
+        
+        if meta is None:
+            self.diskCache.clear()
+            text = self._hgLog("all()")
+            self.diskCache.write([l for l in text.strip().split("\n") if l], tipRev, nodes[tipRev], append=False)
+            return
+        if tipRev <= meta["tipRev"]:
+            return
+        
+        # The parents of the new change sets are fetched again because they have new children. The tags of older
+        # change sets change too: the previous tip loses the tip tag and tags are added, moved or removed. So the
+        # change sets tagged now and the ones the cache has tags for are fetched again as well.
+        cached = self.diskCache.index()
+        tagged = [r for r, l in cached.items() if CSetDiskCache.tagsField.search(l).group(1)]
+        revset = "({s}:) + parents({s}:) + rev({t}) + tag()".format(s=meta["tipRev"] + 1, t=meta["tipRev"])
+        revset += "".join(" + rev({})".format(r) for r in sorted(tagged))
+        text = self._hgLog(revset)
+        
+        # Only the records which are new or have changed are appended
+        lines = []
+        for l in text.strip().split("\n"):
+            m = HG_REV_FIELD.search(l)
+            if m and cached.get(int(m.group(1))) != l.strip():
+                lines.append(l.strip())
+        self.diskCache.write(lines, tipRev, nodes[tipRev])
+    
+    def _runCached(self):
+        self._updateDiskCache()
+        
+        self.revIndex = dict()
+        self.missingRevs = set()
+        cached = self.diskCache.readLines()
+        self.revIndex = self.diskCache.index(cached)
+        
+        self.lines = [self.revIndex[r] for r in sorted(self.revIndex)]
+        if self.windowed:
+            # The cache holds the whole repository. Only ask hg for the revision numbers in the window.
+            window = self.windowRevs()
+            self.records = self.branchQuery.records("\n".join(self.revIndex[r] for r in sorted(window) if r in self.revIndex))
+        else:
+            self.records = self.branchQuery.records("\n".join(self.lines))
+        self.current = 0
+        
+        meta = self.diskCache.load()
+        if len(cached) > 2 * len(self.lines):
+            self.diskCache.compact(self.lines, meta["tipRev"], meta["tipNode"])
+        
+        return True if self.records else False
+    
     def run(self):
         """Run hg command to return a tuple of the standard output and standard error output
         Return: True - successfully loaded data
                 False - no data loaded
+        Raise HgCommandError if hg fails.
         """
+        if self.diskCache:
+            return self._runCached()
         
-        proc = subprocess.Popen(["hg", "log", '-r', self.query, "--template", self.template],
-                                cwd=self.repo, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=os.environ)
-        (stdoutId, stderrId) = proc.communicate()
+        self.revIndex = dict()
+        self.missingRevs = set()
+        if self.streaming:
+            # Wait for the first change set only, so that a failing query is reported here like in the other modes
+            self.streamErrors = []
+            self.stream = self._streamCSets()
+            self.first  = None
+            try:
+                self.first = next(self.stream, None)
+            finally:
+                if self.first is None:
+                    self.stream = None
+            return self.first is not None
         
-        if stderrId:
-            print("\nThere are errors: {}".format(stderrId))
-            return False
+        # The queries and the prefetch of their neighbours in other branches run at the same time
+        revsets = self.queries + [self._closureQuery()] if self.prefetch else self.queries
+        results = self._hgLogs(revsets)
+        for r in results[:len(self.queries)]:
+            if isinstance(r, HgCommandError):
+                raise r
         
-        self.lines = stdoutId.decode("utf-8").strip().split("\n")
+        if len(self.queries) == 1:
+            text = results[0]
+        else:
+            # Merge the release lines in revision order like a single query would return them
+            byRev = dict()
+            for t in results[:len(self.queries)]:
+                for l in t.strip().split("\n"):
+                    m = HG_REV_FIELD.search(l)
+                    if m:
+                        byRev.setdefault(int(m.group(1)), l)
+            text = "\n".join(byRev[r] for r in sorted(byRev))
+        
+        self.lines = text.strip().split("\n")
+        self.records = self.branchQuery.records(text)
+        self.current = 0
+        
+        self._indexLines(self.lines)
+        if self.prefetch and not isinstance(results[-1], HgCommandError):
+            self._indexLines(results[-1].strip().split("\n")) # Not fatal if it fails, see _prefetchClosure
         
         return True if self.lines else False
     
+    def allLines(self):
+        """
+        Return the records of all the change sets of the repository in revision order. They come from the disk cache
+        if there is one. Raise HgCommandError if hg fails.
+        """
+        if self.diskCache:
+            self._updateDiskCache()
+            index = self.diskCache.index()
+            return [index[r] for r in sorted(index)]
+        
+        text = self._hgLog("all()")
+        return [l for l in text.strip().split("\n") if l]
+    
+    def windowRevs(self):
+        """
+        Return the revision numbers of the queried change sets. Raise HgCommandError if hg fails.
+        """
+        return set(int(r) for r in self._hgLog(self.query, "{rev}\n").split())
+    
     def __iter__(self):
+        if self.stream is not None:
+            return self._iterStream(self.first)
         return self
     
     def __next__(self):
-        if self.current >= len(self.lines):
-            raise StopIteration
-        else:
-            self.current += 1
-            while self.current >= 1 and self.current <= len(self.lines):
-                m = re.search(self.queryStr, self.lines[self.current - 1])
-                if m:
-                    return self.lines[self.current - 1]
-                self.current += 1
-            
+        if self.current >= len(self.records):
             raise StopIteration
+        self.current += 1
+        return CSetParser.parse(self.records[self.current - 1])
     
     def getCSetFromRepo(self, hgrev):
-        proc = subprocess.Popen(["hg", "log", '-r', hgrev, "--template", self.template], cwd=self.repo, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=os.environ)
-        (stdoutId, stderrId) = proc.communicate()
-
-        if stderrId:
+        if hgrev in self.missingRevs:
             return None
+        
+        res = self.revIndex.get(hgrev)
+        if res is None:
+            stats.count("repoFallbacks") # One hg log for one revision
+            try:
+                res = self._hgLog(str(hgrev)).strip()
+            except HgCommandError:
+                res = None # An unknown revision
+            if not res:
+                self.missingRevs.add(hgrev)
+                return None
 
-        res = stdoutId.decode("utf-8").strip()
-        x = json.loads("{" + res + "}", object_hook=lambda d: namedtuple('CSet', d.keys())(*d.values()))
+        x = CSetParser.parse(res)
         
-        CSetCache.add(x)
+        self.cache.add(x)
         
         return x
+    
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        if self.cmdServer:
+            self.cmdServer.close()
 
 
-# In[68]:
+# In[72]:
 
 
 class CSetSource(object):
-    def __init__(self, fileName, queryStr):
+    # Files smaller than this are parsed serially even if there are parse workers
+    parallelMinSize = 4 * 1024 * 1024
+    
+    def __init__(self, fileName, queryStr, streaming=False, cache=None, workers=1):
         self.fileName = fileName
+        self.cache    = cache if cache is not None else CSetCache() # The change sets retrieved by getCSetFromRepo
         self.queryStr = queryStr
+        self.branchQuery = BranchQuery(queryStr)
         self.current  = 0
+        self.lines    = []
+        self.records  = array('l') # Indexes of the lines which satisfy the query, the lines aren't copied
+        
+        # In streaming mode the file is memory-mapped instead of being read into memory. Records are
+        # yielded from the map and random access is served through byte offsets (see _buildOffsetIndex).
+        self.streaming = streaming
+        self.mm        = None
+        self.revs      = array('l')
+        self.offsets   = array('q')
+        
+        # A binary snapshot (see CSetSnapshot) is always mapped and its rows are served without parsing
+        self.snapshot  = None
+        
+        # With more than one worker a big file is parsed in chunks by a pool of processes (see _parseParallel).
+        # parsed is the list of the change sets which satisfy the query then, in the order of the file.
+        self.workers   = workers
+        self.parsed    = None
+        
+        # Index of revision number -> line, built once by run(). Revisions which are not in the file are
+        # remembered in missingRevs so that repeated misses don't need another lookup.
+        self.revIndex    = dict()
+        self.missingRevs = set()
         
         # Each line of Change Set file must follow the following format as defined in the hggraph.yaml file.
 
@@ -325,6 +1700,12 @@ class CSetSource(object):
         Return: True - successfully loaded data
                 False - no data loaded
         """
+        if CSetSnapshot.isSnapshot(self.fileName):
+            self.close()
+            self.snapshot = CSetSnapshot(self.fileName)
+            return self.snapshot.open()
+        if self.streaming:
+            return self._mapFile()
         
         with open(self.fileName, 'r') as f:
             data = f.read()
@@ -333,46 +1714,308 @@ class CSetSource(object):
             print("\nThere are errors opening file {}".format(self.fileName))
             return False
         
-        self.lines = data.strip().split("\n")
+        parallel = self.workers > 1 and len(data) >= CSetSource.parallelMinSize
+        # data.strip() would copy the whole file once more, so the blank lines at the ends are dropped instead
+        lines = data.split("\n")
+        del data
+        start, end = 0, len(lines)
+        while start < end and not lines[start].strip():
+            start += 1
+        while end > start and not lines[end - 1].strip():
+            end -= 1
+        self.lines = lines if (start, end) == (0, len(lines)) else lines[start:end]
         self.current = 0
+        self.parsed  = None
+        self.records = array('l')
+        if parallel:
+            self.parsed  = self._parseParallel()
+        else:
+            self.records = self.branchQuery.rows(self.lines)
+        self._buildRevIndex()
 
         return True
     
+    def _chunks(self, count):
+        """
+        Split the file into count chunks of about the same size at line boundaries. Return a list of (start, end)
+        byte offsets.
+        """
+        size = os.path.getsize(self.fileName)
+        bounds = [0]
+        with open(self.fileName, 'rb') as f:
+            for i in range(1, count):
+                f.seek(max(size * i // count, bounds[-1]))
+                f.readline() # Move to the start of the next line
+                bounds.append(min(f.tell(), size))
+        bounds.append(size)
+        return [(a, b) for a, b in zip(bounds, bounds[1:]) if a < b]
+    
+    # The string fields of a CSet sent back by a parse worker, see _parseChunk
+    chunkFields = ("branch", "children", "user", "date", "message", "tags", "node", "p1node", "p2node")
+    
+    @staticmethod
+    def _parseChunk(job):
+        """
+        Parse the records between the byte offsets start and end of the file which satisfy the query. Run by the
+        parse workers.
+        
+        Pickling CSets costs more than parsing them, so the change sets are sent back as one string of their
+        string fields separated by NUL and an array of rev, p1rev and p2rev. If a field contains a NUL itself the
+        CSets are sent instead.
+        """
+        fileName, queryStr, start, end = job
+        with open(fileName, 'rb') as f:
+            f.seek(start)
+            text = f.read(end - start).decode("utf-8")
+        csets = [CSetParser.parse(r) for r in BranchQuery(queryStr).records(text)]
+        
+        fields = "\0".join(getattr(c, f) for c in csets for f in CSetSource.chunkFields)
+        if fields.count("\0") != max(len(csets) * len(CSetSource.chunkFields) - 1, 0):
+            return csets
+        return fields, array('i', (r for c in csets for r in (c.rev, c.p1rev, c.p2rev)))
+    
+    @staticmethod
+    def _mergeChunk(chunk, parsed):
+        """
+        Append the CSets of a chunk returned by _parseChunk to parsed.
+        """
+        if isinstance(chunk, list):
+            parsed.extend(chunk)
+            return
+        
+        text, revs = chunk
+        if not revs:
+            return
+        fields = text.split("\0")
+        width  = len(CSetSource.chunkFields)
+        for i in range(len(revs) // 3):
+            branch, children, user, date, message, tags, node, p1node, p2node = fields[i * width:(i + 1) * width]
+            parsed.append(CSet(branch, children, user, date, message, tags, revs[i * 3], node,
+                               p1node, revs[i * 3 + 1], p2node, revs[i * 3 + 2]))
+    
+    def _parseParallel(self):
+        """
+        Parse the file in chunks in a pool of workers and merge the change sets in the order of the file, which is
+        the order the serial path yields them in. A few chunks per worker keep the workers busy until the end.
+        """
+        jobs = [(self.fileName, self.queryStr, a, b) for a, b in self._chunks(self.workers * 4)]
+        parsed = []
+        with multiprocessing.Pool(min(self.workers, len(jobs))) as pool:
+            for chunk in pool.imap(CSetSource._parseChunk, jobs):
+                CSetSource._mergeChunk(chunk, parsed)
+        stats.count("recordsParsed", len(parsed))
+        stats.count("parseChunks", len(jobs))
+        return parsed
+    
+    def _buildRevIndex(self):
+        """
+        Index all the lines by revision number so that getCSetFromRepo doesn't need to scan the file.
+        """
+        self.revIndex = dict()
+        self.missingRevs = set()
+        for l in self.lines:
+            m = HG_REV_FIELD.search(l)
+            if m:
+                self.revIndex.setdefault(int(m.group(1)), l)
+    
+    def _mapFile(self):
+        self.close()
+        with open(self.fileName, 'rb') as f:
+            try:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError: # Empty file can't be mapped
+                self.mm = None
+        
+        if self.mm is None or not re.search(rb"\S", self.mm):
+            print("\nThere are errors opening file {}".format(self.fileName))
+            self.close()
+            return False
+        
+        self._buildOffsetIndex()
+        return True
+    
+    def _buildOffsetIndex(self):
+        """
+        Index the byte offset of every line by revision number. The index is kept as two parallel arrays
+        sorted by revision so that it costs a few bytes per change set instead of a copy of the line.
+        """
+        self.missingRevs = set()
+        pairs = []
+        for m in HG_REV_FIELD_BYTES.finditer(self.mm):
+            pairs.append((int(m.group(1)), self.mm.rfind(b"\n", 0, m.start()) + 1))
+        
+        # The same line could be matched twice only if a message contains the rev field. Keep the first.
+        pairs.sort()
+        self.revs    = array('l')
+        self.offsets = array('q')
+        for r, o in pairs:
+            if self.revs and self.revs[-1] == r:
+                continue
+            self.revs.append(r)
+            self.offsets.append(o)
+    
+    def _readLine(self, offset):
+        end = self.mm.find(b"\n", offset)
+        if end < 0:
+            end = len(self.mm)
+        return self.mm[offset:end].decode("utf-8").strip()
+    
+    def _iterMapped(self):
+        """
+        Generator yielding the change sets of the memory-mapped file which satisfy the query.
+        """
+        for start, end in self.branchQuery.spans(self.mm):
+            yield CSetParser.parse(self.mm[start:end].decode("utf-8").strip())
+    
+    def _iterSnapshot(self):
+        """
+        Generator yielding the change sets of the snapshot which satisfy the query, in the order of the csetFile.
+        """
+        for row in range(len(self.snapshot)):
+            if self.branchQuery.matches(self.snapshot.branchName(row)):
+                stats.count("snapshotRecords")
+                yield self.snapshot.cset(row)
+    
+    def _lookupLine(self, hgrev):
+        try:
+            r = int(hgrev)
+        except ValueError:
+            return None
+        if self.mm is None:
+            return self.revIndex.get(r)
+        i = bisect.bisect_left(self.revs, r)
+        if i < len(self.revs) and self.revs[i] == r:
+            return self._readLine(self.offsets[i])
+        return None
+    
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        if self.snapshot is not None:
+            self.snapshot.close()
+            self.snapshot = None
+    
     def __iter__(self):
+        if self.snapshot is not None:
+            return self._iterSnapshot()
+        if self.streaming:
+            return self._iterMapped()
         return self
     
     def __next__(self):
-        if self.current >= len(self.lines):
-            raise StopIteration
-        else:
+        if self.parsed is not None:
+            if self.current >= len(self.parsed):
+                raise StopIteration
             self.current += 1
-            while self.current >= 1 and self.current <= len(self.lines):
-                m = re.search(self.queryStr, self.lines[self.current - 1])
-                if m:
-                    return self.lines[self.current - 1]
-                self.current += 1
-            
+            return self.parsed[self.current - 1]
+        
+        if self.current >= len(self.records):
             raise StopIteration
+        self.current += 1
+        return CSetParser.parse(self.lines[self.records[self.current - 1]].strip())
     
     def getCSetFromRepo(self, hgrev):
-        s = None
-        for l in self.lines:
-            if '''"rev":"{}"'''.format(hgrev) in l:
-                s = l
-                break
-                
+        if hgrev in self.missingRevs:
+            return None
+        
+        if self.snapshot is not None:
+            try:
+                row = self.snapshot.row(int(hgrev))
+            except ValueError:
+                row = None
+            if row is None:
+                self.missingRevs.add(hgrev)
+                return None
+            stats.count("snapshotRecords")
+            x = self.snapshot.cset(row)
+            self.cache.add(x)
+            return x
+        
+        s = self._lookupLine(hgrev)
         if s == None:
+            self.missingRevs.add(hgrev)
             return None
         
-        res = s.strip()
-        x = json.loads("{" + res + "}", object_hook=lambda d: namedtuple('CSet', d.keys())(*d.values()))
+        x = CSetParser.parse(s.strip())
         
-        CSetCache.add(x)
+        self.cache.add(x)
         
         return x
 
 
-# In[69]:
+class RepoCSets(object):
+    """
+    All the change sets of one repository, loaded once and shared by the batch jobs on the repository. A record is
+    parsed the first time a job needs it.
+    """
+    def __init__(self, lines):
+        self.lines  = lines
+        self.parsed = dict()
+        self.revIndex = dict()
+        for l in lines:
+            m = HG_REV_FIELD.search(l)
+            if m:
+                self.revIndex[int(m.group(1))] = l
+    
+    def cset(self, rev):
+        c = self.parsed.get(rev)
+        if c is None:
+            l = self.revIndex.get(rev)
+            if l is None:
+                return None
+            c = CSetParser.parse(l)
+            self.parsed[rev] = c
+        return c
+
+
+class SharedCSetSource(object):
+    """
+    Change set source of one query over the RepoCSets of a repository. The change sets can be narrowed down to the
+    revisions in window.
+    """
+    def __init__(self, repoCsets, queryStr, window=None, cache=None):
+        self.repoCsets   = repoCsets
+        self.cache       = cache if cache is not None else CSetCache()
+        self.queryStr    = queryStr
+        self.branchQuery = BranchQuery(queryStr)
+        self.window  = window
+        self.current = 0
+        self.revs    = []
+    
+    def run(self):
+        """
+        Return: True - successfully loaded data
+                False - no data loaded
+        """
+        lines = self.repoCsets.lines
+        if self.window is not None:
+            lines = [self.repoCsets.revIndex[r] for r in sorted(self.window) if r in self.repoCsets.revIndex]
+        records = self.branchQuery.records("\n".join(lines))
+        self.revs = [int(HG_REV_FIELD.search(r).group(1)) for r in records]
+        self.current = 0
+        return True if self.revs else False
+    
+    def __iter__(self):
+        return self
+    
+    def __next__(self):
+        if self.current >= len(self.revs):
+            raise StopIteration
+        self.current += 1
+        return self.repoCsets.cset(self.revs[self.current - 1])
+    
+    def getCSetFromRepo(self, hgrev):
+        x = self.repoCsets.cset(hgrev)
+        if x is not None:
+            self.cache.add(x)
+        return x
+    
+    def close(self):
+        pass
+
+
+# In[73]:
 
 
 class HgGraph(object):
@@ -392,9 +2035,22 @@ class HgGraph(object):
                 \
                  \-----feature branch----<tip>
     """
-    def __init__(self, hgCommand):
+    # Kinds of links in the order buildChangeSets adds them. When two kinds produce the same link, the type of
+    # the one added first is kept.
+    LINK_TAIL, LINK_TIP, LINK_MERGE, LINK_BRANCH = range(4)
+    LINK_TYPES = ("BR", "H", "M", "BR")
+    
+    def __init__(self, hgCommand, cache=None):
         self.hgCommand = hgCommand
         
+        # The CSet cache is shared with the change set source unless another one is given
+        self.cache = cache if cache is not None else hgCommand.cache
+        
+        # All the change sets of the graph, including the ones fetched from other branches. The graph is built
+        # on the integer rows of the store. CSet objects are only created for the change sets in the output.
+        self.store = CSetStore()
+        self.csets = dict() # row -> CSet
+        
         # Store tuples of CSet relationship (from_cset, to_cset). There could be more than when we
         # scan different branches. So need to eliminate the dupes as well.
         self.brLinks = dict()
@@ -404,155 +2060,433 @@ class HgGraph(object):
         self.tipCsets = dict()
         
         # stores CSet from other branch merged to this branch and branched to other branch
-        self.leafCsets= []
+        self.leafCsets = dict()
         
-    def _addBrLinkIfNotExist(self, start, end, type):
-        key = start.rev + end.rev
-        try:
-            r = self.brLinks.get(key)
-            if r != None:
-                return  # Exists. Just return
-        except KeyError:
-            pass
-        self.brLinks[key] = (start, end, type)
+        # Stores unique branch names
+        self.branches = set()
+        
+        # Stores list of CSets keyed by branch names
+        self.brs = dict()
+        self.mainBranch = None
+        
+        # Number of change sets hidden behind a branch line. Only a GraphSummary has any.
+        self.collapsed = dict()
+        
+        # queried flags the rows of the queried change sets. keptRows holds the rows kept in the graph, sorted by
+        # revision and keyed by branch id, keptRevs their revisions to bisect. Each kept row remembers the links it
+        # contributes so that apply() can replace them. A link or node contributed by several rows is counted and only
+        # removed with its last one.
+        self.queried    = bytearray()
+        self.keptRows   = dict()
+        self.keptRevs   = dict()
+        self.rowLinks   = dict()
+        self.linkKinds  = dict() # link key -> {kind: count}
+        self.nodeCounts = collections.Counter()
+        
+    def _cset(self, row):
+        c = self.csets.get(row)
+        if c is None:
+            c = self.store.cset(row)
+            self.csets[row] = c
+            self.cache.add(c) # The change sets in the graph can be looked up by tag, node etc.
+        return c
+    
+    def _refreshCSet(self, row):
+        """
+        Bring the CSet of a row which has been updated in the store up to date. It is updated in place because the
+        links and nodes of other rows can hold it.
+        """
+        fresh = self.store.cset(row)
+        c = self.csets.get(row)
+        if c is not None:
+            c.tags, c.children = fresh.tags, fresh.children
+            fresh = c
+        self.cache.replace(fresh)
     
     def _searchOrGetCSet(self, rev):
+        """
+        Return the row of the revision in the store. Change sets which are not loaded yet are retrieved from
+        the cache or the repository and added to the store.
+        """
         if rev == HG_NO_PARENT_REV:
             return None
-        c = CSetCache.searchCSet(rev)
+        row = self.store.row(rev)
+        if row is not None:
+            return row
+        c = self.cache.searchCSet(rev)
         if c == None:
             c = self.hgCommand.getCSetFromRepo(rev)
-        return c
+            if c == None:
+                return None
+        return self.store.add(c)
     
-    def _addSourceParentBranch(self, b, l, type):
-        p1 = self._searchOrGetCSet(l.p1rev)
-        p2 = self._searchOrGetCSet(l.p2rev)
+    def _classify(self, row):
+        """
+        Resolve the parents and children of the change set once and classify it. Only merges, branching points,
+        tips and tagged change sets are kept in the graph.
         
-        if p1 != None and p1.branch != b:
-            self._addBrLinkIfNotExist(p1, l, type)
-            self.tailCsets[p1.rev] = p1
-            
-        if p2 != None and p2.branch != b:
-            self._addBrLinkIfNotExist(p2, l, type)
-            self.tailCsets[p2.rev] = p2
-
-    def _addParentBranch(self, b, l, type):
-        p1 = self._searchOrGetCSet(l.p1rev)
-        p2 = self._searchOrGetCSet(l.p2rev)
+        Return a tuple (kept, neighbours) where neighbours is a tuple of the rows of the parents and children in
+        other branches and whether the change set is the tip of its branch.
+        """
+        store = self.store
+        branchId = store.branchIds[row]
+        p1, p2 = store.p1[row], store.p2[row]
+        
+        parents = []
+        for rev in (p1, p2):
+            p = self._searchOrGetCSet(rev)
+            if p is not None and store.branchIds[p] != branchId:
+                parents.append(p)
+        
+        children = []
+        isTip = True
+        for rev in store.children(row):
+            c = self._searchOrGetCSet(rev)
+            if c is None:
+                continue
+            if store.branchIds[c] != branchId:
+                children.append(c)
+            else:
+                isTip = False
+        
+        isMerge = (p1 != HG_NO_PARENT_REV and p2 != HG_NO_PARENT_REV) or len(parents) > 0
+        kept = isMerge or len(children) > 0 or isTip or store.tagIds[row] != 0
+        return kept, (parents, children, isTip)
+    
+    def _rowLinks(self, row, first, last, neighbours):
+        """
+        Return the links a kept row contributes as tuples (kind, from_cset, to_cset, type, node) where node is the
+        tail, tip or leaf CSet the link adds to the graph:
+        - the first change set of a branch is linked from its parents in other branches (tails)
+        - the last change set of a branch is linked to a tip if it has no children in the branch
+        - the other change sets are linked from their parents in other branches (merges)
+        - all of them are linked to their children in other branches (branching)
+        """
+        parentRows, childRows, isTip = neighbours
+        me = self._cset(row)
+        links = []
+        parents = [self._cset(p) for p in parentRows]
         
-        if p1 != None and p1.branch != b:
-            self._addBrLinkIfNotExist(p1, l, type)
-            self.leafCsets.append(p1)
+        if first:
+            links.extend((HgGraph.LINK_TAIL, p, me, "BR", p) for p in parents)
+        if last and isTip:
+            tip = CSet(rev="{}Tip".format(me.rev), branch="Tip")
+            links.append((HgGraph.LINK_TIP, me, tip, "H", tip))
+        if not first:
+            links.extend((HgGraph.LINK_MERGE, p, me, "M", p) for p in parents)
+        for c in childRows:
+            child = self._cset(c)
+            links.append((HgGraph.LINK_BRANCH, me, child, "BR", child))
+        return links
+    
+    def _nodesOf(self, kind):
+        """
+        Return the group of the nodes a kind of link adds and the dict which holds them.
+        """
+        if kind == HgGraph.LINK_TAIL:
+            return "tail", self.tailCsets
+        if kind == HgGraph.LINK_TIP:
+            return "tip", self.tipCsets
+        return "leaf", self.leafCsets
+    
+    def _addLinks(self, links):
+        for kind, start, end, type, node in links:
+            key = (start.rev, end.rev)
+            kinds = self.linkKinds.setdefault(key, collections.Counter())
+            kinds[kind] += 1
+            if key not in self.brLinks or (kinds[kind] == 1 and kind == min(kinds)):
+                self.brLinks[key] = (start, end, type)
             
-        if p2 != None and p2.branch != b:
-            self._addBrLinkIfNotExist(p2, l, type)
-            self.leafCsets.append(p2)
+            group, nodes = self._nodesOf(kind)
+            self.nodeCounts[(group, node.rev)] += 1
+            nodes[node.rev] = node
+    
+    def _removeLinks(self, links):
+        for kind, start, end, type, node in links:
+            key = (start.rev, end.rev)
+            kinds = self.linkKinds[key]
+            kinds[kind] -= 1
+            if kinds[kind] == 0:
+                del kinds[kind]
+                if not kinds:
+                    del self.linkKinds[key]
+                    del self.brLinks[key]
+                elif kind < min(kinds):
+                    # The link stays because of another kind of contribution. Use the type of that one.
+                    self.brLinks[key] = (start, end, HgGraph.LINK_TYPES[min(kinds)])
             
-    def _addBranchTip(self, b, l, type):
-        if not self._isTip(l): # Return, this is not the last change set in this branch.
+            group, nodes = self._nodesOf(kind)
+            self.nodeCounts[(group, node.rev)] -= 1
+            if self.nodeCounts[(group, node.rev)] == 0:
+                del self.nodeCounts[(group, node.rev)]
+                del nodes[node.rev]
+    
+    def _relinkRow(self, branchId, row):
+        """
+        Replace the links contributed by the row with the ones for its current position in the branch.
+        """
+        self._removeLinks(self.rowLinks.pop(row, []))
+        kept = self.keptRows.get(branchId, [])
+        i = self._keptIndex(branchId, row)
+        if i is None:
             return
-        tip = CSet(rev=l.rev + "Tip", branch="Tip")
-        self._addBrLinkIfNotExist(l, tip, type)
-        self.tipCsets[tip.rev] = tip
-   
-    def _addBranchingLinks(self, b, l, type):
-        cs = [x.split(":")[0] for x in l.children.split(" ")]
-        children = []
+        links = self._rowLinks(row, i == 0, i == len(kept) - 1, self._classify(row)[1])
+        self.rowLinks[row] = links
+        self._addLinks(links)
+    
+    def _keptIndex(self, branchId, row):
+        kept = self.keptRows.get(branchId, [])
+        i = bisect.bisect_left(self.keptRevs.get(branchId, []), self.store.revs[row])
+        if i < len(kept) and kept[i] == row:
+            return i
+        return None
+    
+    def _isQueried(self, row):
+        return row < len(self.queried) and self.queried[row] == 1
+    
+    def _setQueried(self, row):
+        if row >= len(self.queried):
+            self.queried.extend(bytes(row + 1 - len(self.queried)))
+        self.queried[row] = 1
+    
+    def _inQuery(self, cset):
+        branchQuery = getattr(self.hgCommand, "branchQuery", None)
+        return branchQuery is None or branchQuery.matches(cset.branch)
+    
+    def buildChangeSets(self):
+        """
+        Takes in the standard out of the HgCommand.run() and build Mercurial change sets
+        """
+        # Rows of the queried change sets, grouped by branch id in the order they are read
+        rows = dict()
         
-        for e in cs:
-            c = self._searchOrGetCSet(e)
-            if c and c.branch != l.branch:
-                children.append(c)
+        for x in self.hgCommand:
+            row = self.store.add(x)
+            self._setQueried(row)
+            rows.setdefault(self.store.branchIds[row], []).append(row)
         
-        if len(children) == 0:
+        if not rows:
             return
-        for c in children:
-            self._addBrLinkIfNotExist(l, c, type)
-            self.leafCsets.append(c)
-
-    def _isMerge(self, cset):
-        if cset.p1rev != HG_NO_PARENT_REV and cset.p2rev != HG_NO_PARENT_REV:
-            return True
-        if cset.p1rev == HG_NO_PARENT_REV and cset.p2rev == HG_NO_PARENT_REV:
-            return False
-        p = cset.p1rev if cset.p1rev != HG_NO_PARENT_REV else cset.p2rev
-        c = self._searchOrGetCSet(p)
-        if c.branch != cset.branch:
-            return True
-        return False
+        
+        # One pass over the change sets of each branch in revision order. The neighbours of each change set are
+        # resolved once and used both to classify it and to create its links. The links are collected by kind
+        # because tails are added first, then tips, merges and branching links like they are shown in the graph.
+        linksByKind = ([], [], [], [])
+        for key in sorted(rows, key=self.store.branchName):
+            l = rows[key]
+            l.sort(key=self.store.revs.__getitem__) # Already in order unless the source isn't sorted
+            
+            kept = []
+            neighbours = []
+            for row in l:
+                k, n = self._classify(row)
+                if k:
+                    kept.append(row)
+                    neighbours.append(n)
+            
+            for i, row in enumerate(kept):
+                links = self._rowLinks(row, i == 0, i == len(kept) - 1, neighbours[i])
+                self.rowLinks[row] = links
+                for e in links:
+                    linksByKind[e[0]].append(e)
+            
+            self.keptRows[key] = kept
+            self.keptRevs[key] = [self.store.revs[r] for r in kept]
+            self.brs[self.store.branchName(key)] = [self._cset(r) for r in kept]
+        self.branches = set(self.brs.keys())
+        
+        # We need to find out the main branch. It must be the one which has the first CSet in the list.
+        self.mainBranch = self.store.branchName(self.store.branchIds[0])
+        
+        for links in linksByKind:
+            self._addLinks(links)
     
-    def _isBranch(self, cset):
-        if cset.children == "":
-            return False
+    def apply(self, newCsets):
+        """
+        Update the graph with change sets appended to the repository since it was built. newCsets should hold all
+        the new change sets, not only the queried ones, because a change set in another branch can turn a queried
+        change set into a branching point. Only the new change sets and their parents are classified again, and only
+        their links and the links of the first and last change sets of the affected branches are replaced.
         
-        cs = [x.split(":")[0] for x in cset.children.split(" ")]
-        for e in cs:
-            c = self._searchOrGetCSet(e)
-            if c and c.branch != cset.branch:
-                return True
-
-    def _isTip(self, cset):
-        if cset.children == "":
-            return True
+        Tags are not new change sets: newCsets must also hold the records read again of the previous tip, which
+        loses the tip tag, and of the change sets which have been tagged or untagged, like the ones CSetDiskCache
+        reads with rev(<old tip>) + tag(). A record of a change set in the graph updates its tags and children and
+        the change set is classified again.
         
-        cs = [x.split(":")[0] for x in cset.children.split(" ")]
-        for e in cs:
-            c = self._searchOrGetCSet(e)
-            if c and c.branch == cset.branch:
-                return False
-        return True
+        Return the names of the branches which have changed.
+        """
+        affected = set()
+        for c in newCsets:
+            # The change set could have been retrieved already as a neighbour of another new change set, or it is
+            # a record read again of a change set in the graph
+            row = self.store.row(c.rev)
+            if row is None:
+                row = self.store.add(c)
+            elif self.store.update(row, c):
+                self._refreshCSet(row)
+                affected.add(row)
+            for p in Utils.getParentRevs(c):
+                pr = self.store.row(p)
+                if pr is not None:
+                    # The parent is classified again even if its record named the child already, e.g. a csetFile
+                    # exported before the child was committed
+                    if c.rev not in self.store.children(pr):
+                        self.store.addChild(pr, c.rev)
+                    affected.add(pr)
+            
+            if self._inQuery(c) and not self._isQueried(row):
+                self._setQueried(row)
+                affected.add(row)
+        
+        byBranch = dict()
+        for row in affected:
+            if self._isQueried(row):
+                byBranch.setdefault(self.store.branchIds[row], set()).add(row)
+        
+        for branchId, rows in byBranch.items():
+            kept = self.keptRows.setdefault(branchId, [])
+            keptRevs = self.keptRevs.setdefault(branchId, [])
+            relink = set(rows)
+            if kept:
+                relink.update((kept[0], kept[-1]))
+            
+            for row in rows:
+                i = self._keptIndex(branchId, row)
+                if self._classify(row)[0]:
+                    if i is None:
+                        i = bisect.bisect_left(keptRevs, self.store.revs[row])
+                        kept.insert(i, row)
+                        keptRevs.insert(i, self.store.revs[row])
+                elif i is not None:
+                    del kept[i]
+                    del keptRevs[i]
+            
+            if kept:
+                relink.update((kept[0], kept[-1]))
+            for row in sorted(relink, key=self.store.revs.__getitem__):
+                self._relinkRow(branchId, row)
+            
+            name = self.store.branchName(branchId)
+            if kept:
+                self.brs[name] = [self._cset(r) for r in kept]
+            else:
+                self.keptRows.pop(branchId)
+                self.keptRevs.pop(branchId)
+                self.brs.pop(name, None)
+        
+        self.branches = set(self.brs.keys())
+        if self.mainBranch is None and self.brs:
+            self.mainBranch = self.store.branchName(self.store.branchIds[0])
+        return sorted(self.store.branchName(b) for b in byBranch)
     
-    def buildChangeSets(self):
+    def summarize(self, collapseLinear=False, topBranches=0, activeDays=0, dropMergedDays=0, now=None):
         """
-        Takes in the standard out of the HgCommand.run() and build Mercurial change sets
+        Return a GraphSummary, a smaller view of the graph which Graphviz can lay out in reasonable time. Options
+        which are 0 or False are not applied:
+        - activeDays: keep only the branches with a change set committed in the last activeDays days
+        - dropMergedDays: drop the branches whose last change set was merged more than dropMergedDays days ago,
+          by the date of the merge change set
+        - topBranches: keep only the topBranches branches with the most change sets
+        - collapseLinear: hide the change sets which are neither tagged nor linked to another kept branch. Every
+          branch line is labelled with the number of queried change sets of the branch it stands for, whether
+          buildChangeSets has already left them out or they are hidden here.
+        The main branch is always kept. The links between the remaining change sets are the ones in brLinks.
         """
-
-        # Stores unique branch names
-        self.branches = set()
+        store = self.store
+        now = now or datetime.datetime.now()
         
-        # Stores list of CSets keyed by branch names
-        self.brs = dict()
+        # Count and date the change sets of each branch in one pass over the store. Dates are isodate strings,
+        # the minutes prefix sorts like the date itself.
+        counts = collections.Counter()
+        latest = dict()
+        revsOf = dict()
+        for row in range(len(store)):
+            if not self._isQueried(row):
+                continue
+            b = store.branchIds[row]
+            counts[b] += 1
+            date = store.strings[store.dateIds[row]][:16]
+            if date > latest.get(b, ""):
+                latest[b] = date
+            if collapseLinear:
+                revsOf.setdefault(b, []).append(store.revs[row])
         
-        csets = []
+        def daysSince(date):
+            try:
+                date = datetime.datetime.strptime(date[:16], "%Y-%m-%d %H:%M")
+            except ValueError:
+                return 0
+            return (now - date).total_seconds() / 86400
         
-        for cs in self.hgCommand:
-            x = json.loads("{" + cs + "}", object_hook=lambda d: namedtuple('CSet', d.keys())(*d.values()))
-            self.branches.add(x.branch)
-            csets.append(x)
-            # Add it to the cache as well
-            CSetCache.add(x)
-
-        data = sorted(csets, key=lambda x: x.branch)
-        for key, items in groupby(data, lambda x: x.branch):
-            l = []
-            for e in items:
-                if self._isMerge(e) or self._isBranch(e) or self._isTip(e) or e.tags != "":
-                    l.append(e)
-            self.brs[key] = sorted(l, key=lambda x: x.rev)
+        def ageInDays(b):
+            return daysSince(latest[b]) if b in latest else 0
         
-        # We need to find out the main branch. It must be the one which has the first CSet in the list.
-        self.mainBranch = csets[0].branch
-        #self.brs[self.mainBranch].insert(0, csets[0])
+        def mergedAgeInDays(b):
+            # Age of the latest merge of the branch head into another branch, None if it isn't merged
+            head = self.keptRows[b][-1]
+            ages = []
+            for rev in store.children(head):
+                r = store.row(rev)
+                if r is not None and store.p2[r] == store.revs[head]:
+                    ages.append(daysSince(store.strings[store.dateIds[r]]))
+            return min(ages) if ages else None
+        
+        keep = [store.branchIdOf[b] for b in self.brs]
+        if activeDays:
+            keep = [b for b in keep if ageInDays(b) <= activeDays]
+        if dropMergedDays:
+            keep = [b for b in keep if (mergedAgeInDays(b) or 0) <= dropMergedDays]
+        if topBranches:
+            top = set(sorted(keep, key=lambda b: -counts[b])[:topBranches])
+            keep = [b for b in keep if b in top]
+        names = set(store.branchName(b) for b in keep)
+        if self.mainBranch in self.brs:
+            names.add(self.mainBranch)
+        
+        brs = dict((b, l) for b, l in self.brs.items() if b in names)
+        dropped = set(c.rev for b, l in self.brs.items() if b not in names for c in l)
+        brLinks = dict((k, v) for k, v in self.brLinks.items() if v[0].rev not in dropped and v[1].rev not in dropped)
+        linked = set()
+        for v in brLinks.values():
+            linked.update((v[0].rev, v[1].rev))
+        
+        collapsed = dict()
+        if collapseLinear:
+            for b, l in brs.items():
+                revs = sorted(revsOf.get(store.branchIdOf[b], []))
+                shown = [c for i, c in enumerate(l) if i == 0 or i == len(l) - 1 or c.tags or c.rev in linked]
+                for prev, c in zip(shown, shown[1:]):
+                    hidden = bisect.bisect_left(revs, c.rev) - bisect.bisect_right(revs, prev.rev)
+                    if hidden:
+                        collapsed[(prev.rev, c.rev)] = hidden
+                brs[b] = shown
+        
+        return GraphSummary(brs       = brs,
+                            brLinks   = brLinks,
+                            tailCsets = dict((k, c) for k, c in self.tailCsets.items() if k in linked),
+                            tipCsets  = dict((k, c) for k, c in self.tipCsets.items() if k in linked),
+                            leafCsets = dict((k, c) for k, c in self.leafCsets.items() if k in linked),
+                            mainBranch = self.mainBranch,
+                            collapsed = collapsed)
 
-        # For the first CSet of each branch, we add it's parent branches
-        for b, l in self.brs.items():
-            self._addSourceParentBranch(b, l[0], "BR")
 
-        # For the last CSet of each branch, we add a tip CSet
-        for b, l in self.brs.items():
-            self._addBranchTip(b, l[-1], "H")
-        
-        # Now, we scan all the branches and add the branching or merge links
-        for b, l in self.brs.items():
-            for i in range(1, len(l)): # Not need to do that for the first CSet
-                self._addParentBranch(b, l[i], "M")
- 
-        for b, l in self.brs.items():
-            for i in range(0, len(l)):
-                self._addBranchingLinks(b, l[i], "BR")
+class GraphSummary(object):
+    """
+    A reduced view of a HgGraph returned by HgGraph.summarize. It has the attributes GraphViz reads from HgGraph.
+    collapsed holds the number of change sets hidden behind a branch line, keyed by (from_cset.rev, to_cset.rev).
+    """
+    def __init__(self, brs, brLinks, tailCsets, tipCsets, leafCsets, mainBranch, collapsed):
+        self.brs        = brs
+        self.brLinks    = brLinks
+        self.tailCsets  = tailCsets
+        self.tipCsets   = tipCsets
+        self.leafCsets  = leafCsets
+        self.mainBranch = mainBranch
+        self.branches   = set(brs.keys())
+        self.collapsed  = collapsed
 
 
-# In[70]:
+# In[74]:
 
 
 class GraphViz(object):
@@ -562,6 +2496,8 @@ class GraphViz(object):
     graphvizTemplate defines Graphviz file format. We use Python string format function to generate the final
     Graphviz DOT file.
     """
+    format = "dot"
+    
     graphvizTemplate = """digraph mecurial {{
     ratio=compress
     rankdir=LR
@@ -579,6 +2515,7 @@ class GraphViz(object):
         self.branchAndMerges = dict()
         
         self.currentColor = 0
+        self.written = False # Set by dumpGraphIfChanged
         
         for dictionary in initial_data:
             for key in dictionary:
@@ -620,98 +2557,211 @@ class GraphViz(object):
         """
         Generate the Graphviz graph and returns it as a string.
         """
-        return GraphViz.graphvizTemplate.format(nodes     = self._generateNodes(),
-                                                subgraphs = self._generateSubgraphs()
-                                               )
+        f = io.StringIO()
+        self.write(f)
+        return f.getvalue()
+    
+    def write(self, fileobj, hashes=None):
+        """
+        Write the Graphviz graph to a text file object, like the one returned by open() or gzip.open(..., 'wt').
+        
+        The nodes, subgraphs and links are written as they are generated so the whole graph is never held in memory.
+        The output is the same as dumpGraph(). If hashes is a dict, the hash of each branch is added to it, see
+        dumpGraphIfChanged.
+        """
+        self.currentColor = 0
+        head, rest = GraphViz.graphvizTemplate.split("{nodes}")
+        middle, tail = rest.split("{subgraphs}")
+        
+        # Only the digest of each node definition is kept for the hashes
+        digests = dict() if hashes is not None else None
+        fileobj.write(head.format())
+        fileobj.write("\n")
+        for rev, line in self._iterNodeDefinitions():
+            fileobj.write(line)
+            if digests is not None:
+                digests[rev] = hashlib.sha1(line.encode("utf-8")).digest()
+        fileobj.write(middle.format())
+        self._writeSubgraphs(fileobj.write, digests, hashes)
+        fileobj.write(tail.format())
+    
+    def dumpGraphIfChanged(self, fileName):
+        """
+        Write the Graphviz graph to the file only if it has changed since the last time it was written.
+        
+        Each branch is hashed together with the definitions of its nodes and the links from or to them. The hashes
+        are kept in <fileName>.hashes. The graph is written once, to a temporary file which replaces the file if a
+        branch has changed or the file doesn't exist. written tells if the file has been written. Return the names
+        of the branches which have changed, including the ones removed. The list is empty if the file has not been
+        rewritten or if a graph without branches has been written.
+        """
+        hashFile = fileName + ".hashes"
+        oldHashes = dict()
+        exists = os.path.exists(fileName)
+        if exists and os.path.exists(hashFile):
+            try:
+                with open(hashFile, 'r') as f:
+                    oldHashes = json.load(f)
+            except ValueError:
+                pass
+        
+        # Keep the .gz suffix of the temporary file so that openOutput compresses it the same way
+        root, ext = (fileName[:-3], ".gz") if fileName.endswith(".gz") else (fileName, "")
+        tmp = root + ".tmp" + ext
+        hashes = dict()
+        with GraphViz.openOutput(tmp) as f:
+            self.write(f, hashes)
+        
+        changed = sorted(b for b in set(hashes) | set(oldHashes) if hashes.get(b) != oldHashes.get(b))
+        self.written = bool(changed) or not exists
+        if not self.written:
+            os.remove(tmp)
+            return changed
+        
+        os.replace(tmp, fileName)
+        with open(hashFile, 'w') as f:
+            json.dump(hashes, f, indent=1, sort_keys=True)
+        return changed
+    
+    @staticmethod
+    def openInput(fileName):
+        """
+        Open the DOT file for reading as bytes, decompressing it if its name ends with .gz.
+        """
+        if fileName.endswith(".gz"):
+            return gzip.open(fileName, 'rb')
+        return open(fileName, 'rb')
     
-    def _generateNodes(self):
+    @staticmethod
+    def openOutput(fileName):
+        """
+        Open the DOT file for writing. The file is gzip compressed if its name ends with .gz.
+        """
+        if fileName.endswith(".gz"):
+            return gzip.open(fileName, 'wt', encoding='utf-8')
+        return open(fileName, 'w', encoding='utf-8')
+    
+    def _iterNodeDefinitions(self):
         """
-        Generate node definitions for 1) all the change sets in the branches; 2) all the tip nodes; 3) all the merge and
+        Generate the DOT node definitions. Yield (rev, definition) pairs.
+        """
+        for c, type, tagName, shape, style, fillColor, fontColor in self._iterNodes():
+            yield c.rev, "\t{}\n".format(Utils.createGraphVizNode(type, c, tagName, shape, style, fillColor, fontColor))
+    
+    def _iterNodes(self):
+        """
+        Generate the nodes for 1) all the change sets in the branches; 2) all the tip nodes; 3) all the merge and
         branching change sets; 4) all the change sets from "other" branches.
+        
+        A change set can be in more than one of them. It is defined once, in the order it is first met, by the last
+        one it is in. Yield tuples (cset, type, tagName, shape, style, fillColor, fontColor).
         """
-        nodes = dict() # We need to avoid duplicate nodes
-
-        for k, c in self.hg.tailCsets.items():
-            tagName = self._extractReValue(self.branchNamePattern, c.branch)
-            nodes[c.rev] = "\t{}\n".format(Utils.createGraphVizNode("TAIL", c, tagName,
-                                        self.tailShape,
-                                        self.tailStyle,
-                                        self.tailFillColor,
-                                        self.tailFontColor))
-
-        for k, c in self.hg.tipCsets.items():
-            nodes[c.rev] = "\t{}\n".format(Utils.createGraphVizNode("TIP", c, "",
-                                        self.tipShape,
-                                        self.tipStyle,
-                                        self.tipFillColor,
-                                        self.tipFontColor))
-            
-        for b, l in self.hg.brs.items():
-            for c in l:
+        tails, tips, leaves = self.hg.tailCsets, self.hg.tipCsets, self.hg.leafCsets
+        brRevs = set(c.rev for l in self.hg.brs.values() for c in l)
+        
+        def define(c):
+            if c.rev in leaves:
+                tagName = self._extractReValue(self.branchNamePattern, c.branch)
+                return c, "LEAF", tagName, self.mbShape, self.mbStyle, self.mbFillColor, self.mbFontColor
+            elif c.rev in brRevs:
                 tagName = self._extractReValue(self.tagNamePattern, c.tags) if c.tags else ""
                 fillColor = self.csetFillColor
                 fontColor = self.csetFontColor
                 if c.tags:
                     fillColor = self.tagFillColor
                     fontColor = self.tagFontColor
-                nodes[c.rev] = "\t{}\n".format(Utils.createGraphVizNode("", c, tagName,
-                                                                      self.csetShape,
-                                                                      self.csetStyle,
-                                                                      fillColor,
-                                                                      fontColor))
-                
-        for c in self.hg.leafCsets:
+                return c, "", tagName, self.csetShape, self.csetStyle, fillColor, fontColor
+            elif c.rev in tips:
+                return c, "TIP", "", self.tipShape, self.tipStyle, self.tipFillColor, self.tipFontColor
             tagName = self._extractReValue(self.branchNamePattern, c.branch)
-            nodes[c.rev] = "\t{}\n".format(Utils.createGraphVizNode("LEAF", c, tagName,
-                                                                      self.mbShape,
-                                                                      self.mbStyle,
-                                                                      self.mbFillColor,
-                                                                      self.mbFontColor))
-
-        s = "\n"
-        for v in nodes.values():
-            s += v
-
-        return s
-            
-    def _generateSubgraphs(self):
+            return c, "TAIL", tagName, self.tailShape, self.tailStyle, self.tailFillColor, self.tailFontColor
+        
+        for c in tails.values():
+            yield define(c)
+        for c in tips.values():
+            if c.rev not in tails:
+                yield define(c)
+        for l in self.hg.brs.values():
+            for c in l:
+                if c.rev not in tails and c.rev not in tips:
+                    yield define(c)
+        for c in leaves.values():
+            if c.rev not in tails and c.rev not in tips and c.rev not in brRevs:
+                yield define(c)
+    
+    def _writeSubgraph(self, write, b, color):
         """
-        Generate one subgraph per branch.
+        Write the subgraph of one branch with the function write.
         """
-        s = ""
+        l = self.hg.brs[b]
         
-        brKeys = self._arrangeBranches()
+        subgName  = "cluster_" if self.subgraphCluster else ""
+        subgName += b.replace(".", "_").replace("-", "_")
         
-        for b in brKeys:
-            l = self.hg.brs[b]
+        write("""edge [color="{color}",fontsize=7,width=0.4,height=0.4, style="{style}"]\n""".format(color=color, style="bold"))
+        write('''\tsubgraph {name} {{\n\t\tlabel="{label}"\n\t\t'''.format(name=subgName, label= b))
+        write("style=invis\n\t\t" if self.subgraphCluster else "")
+        for c in l:
+            write("{}; ".format(Utils.createGraphVizNodeName(c)))
+        write("\n")
+        
+        # Build the graph for each branch first - a straight line. We will only care about the CSet which has multiple parents
+
+        bname = self._extractReValue(self.branchNamePattern, b)
+        collapsed = self.hg.collapsed
+        for i in range(0, len(l) - 1):
+            hidden = collapsed.get((l[i].rev, l[i+1].rev))
+            label = "{} (+{})".format(bname, hidden) if hidden else bname
+            gnodes = Utils.createGraphVizLink(l[i], l[i+1], label)
+            write("\t\t{}\n".format(gnodes[1]))
             
-            subgName  = "cluster_" if self.subgraphCluster else ""
-            subgName += b.replace(".", "_").replace("-", "_")
+        write("\n\t}\n\t")
+    
+    def _generateLink(self, link):
+        gnodes = Utils.createGraphVizLink(link[0], link[1], link[2])
+        return "\t{}\n".format(gnodes[1])
             
-            sg  = """edge [color="{color}",fontsize=7,width=0.4,height=0.4, style="{style}"]\n""".format(color=self._getNextColor(), style="bold")
-            sg += '''\tsubgraph {name} {{\n\t\tlabel="{label}"\n\t\t'''.format(name=subgName, label= b)
-            sg += "style=invis\n\t\t" if self.subgraphCluster else ""
-            for c in l:
-                sg += "{}; ".format(Utils.createGraphVizNodeName(c))
-            sg += "\n"
+    def _writeSubgraphs(self, write, digests=None, hashes=None):
+        """
+        Write one subgraph per branch and the links between them with the function write.
+        
+        With digests, the digests of the node definitions by revision, the hash of each branch is added to hashes.
+        It covers the format, the definitions of the nodes of the branch, its subgraph and the links from or to
+        its nodes together with the definitions of their ends.
+        """
+        hashers = dict()
+        branchesOf = dict() # rev -> the branches it is in, to find the branches of a link in one lookup
+        for b in self._arrangeBranches():
+            color = self._getNextColor()
+            if digests is None:
+                self._writeSubgraph(write, b, color)
+                continue
             
-            # Build the graph for each branch first - a straight line. We will only care about the CSet which has multiple parents
-
-            bname = self._extractReValue(self.branchNamePattern, b)
-            for i in range(0, len(self.hg.brs[b]) - 1):
-                gnodes = Utils.createGraphVizLink(l[i], l[i+1], bname)
-                sg += "\t\t{}\n".format(gnodes[1])
-                
-            s += "{}\n\t}}\n\t".format(sg)
+            h = hashlib.sha1(self.format.encode("utf-8")) # Switching the format rewrites the file
+            for rev in sorted(set(c.rev for c in self.hg.brs[b])):
+                h.update(digests.get(rev, b""))
+                branchesOf.setdefault(rev, []).append(b)
+            def hashedWrite(text, h=h):
+                write(text)
+                h.update(text.encode("utf-8"))
+            self._writeSubgraph(hashedWrite, b, color)
+            hashers[b] = h
                 
         # Go through the merges and branches and create the links.
-        s += "edge [color=blue, style=dashed]\n"
+        write("edge [color=blue, style=dashed]\n")
         for k, v in self.hg.brLinks.items():
-            bname = self._extractReValue(self.branchNamePattern, v[0].branch)
-            gnodes = Utils.createGraphVizLink(v[0], v[1], v[2])
-            s += "\t{}\n".format(gnodes[1])
-            
-        return s
+            link = self._generateLink(v)
+            write(link)
+            if digests is None:
+                continue
+            owners = set(branchesOf.get(v[0].rev, ())) | set(branchesOf.get(v[1].rev, ()))
+            if owners:
+                data = link.encode("utf-8") + digests.get(v[0].rev, b"") + digests.get(v[1].rev, b"")
+                for b in owners:
+                    hashers[b].update(data)
+        
+        if hashes is not None:
+            hashes.update((b, h.hexdigest()) for b, h in hashers.items())
     
     def _arrangeBranches(self):
         # Check to see if we need to arrange the branches
@@ -733,8 +2783,174 @@ class GraphViz(object):
         #return [ x[0] for x in l]
         
 
+class SvgGraph(GraphViz):
+    """
+    Lay out the graph and write it as SVG, without Graphviz.
+    
+    Each branch has a lane, a row of its change sets in revision order. The change sets of the branches which are not
+    in the graph, i.e. the tails and leaves, share one more lane below them. Going through the nodes in revision
+    order, the tip of a branch right after its last change set, each node is placed right of the previous node in
+    its lane and of the nodes linked to it, so all the links point to the right. The shapes and colors are the ones
+    of the DOT output, set by the same hggraph.yaml keys.
+    """
+    format     = "svg"
+    fontSize   = 8
+    charWidth  = 4.8 # Courier at fontSize
+    lineHeight = 10
+    columnGap  = 16
+    laneGap    = 24
+    margin     = 20
+    
+    # Graphviz colors which are not SVG color names. The other ones ending with a digit fall back to the name
+    # without it.
+    x11Colors = {"deepskyblue2": "#00b2ee", "green3": "#00cd00", "green4": "#008b00", "brown1": "#ff4040",
+                 "magenta3": "#cd00cd", "magenta4": "#8b008b", "olivedrab3": "#9acd32", "olivedrab4": "#698b22",
+                 "yellow4": "#8b8b00"}
+    
+    def _svgColor(self, color):
+        color = str(color)
+        return SvgGraph.x11Colors.get(color) or color.rstrip("0123456789") or color
+    
+    def _nodeSize(self, lines, shape):
+        w = max(len(l) for l in lines) * SvgGraph.charWidth + 8
+        h = len(lines) * SvgGraph.lineHeight + 6
+        if shape == "circle":
+            w = h = max(w, h)
+        elif shape == "diamond":
+            w, h = w * 1.6, h * 1.6
+        return w, h
+    
+    def _layout(self):
+        """
+        Place the nodes. Return the lanes as tuples (branch, color), the nodes as tuples (x, y, w, h, lines, node)
+        where node is a tuple of _iterNodes(), and the positions of the nodes keyed by revision.
+        """
+        self.currentColor = 0
+        lanes = [(b, self._getNextColor()) for b in self._arrangeBranches()]
+        laneOf = dict()
+        for i, (b, color) in enumerate(lanes):
+            for c in self.hg.brs[b]:
+                laneOf[c.rev] = i
+        owners = dict((v[1].rev, v[0].rev) for v in self.hg.brLinks.values() if v[1].rev in self.hg.tipCsets)
+        
+        placed = []
+        for node in self._iterNodes():
+            c, type, tagName, shape = node[:4]
+            if type == "TIP":
+                key, lane = (owners.get(c.rev, -1), 1), laneOf.get(owners.get(c.rev), len(lanes))
+            else:
+                key, lane = (c.rev, 0), laneOf.get(c.rev, len(lanes))
+            lines = Utils.createNodeLabel(type, c, tagName)
+            placed.append((key, lane, lines, self._nodeSize(lines, shape), node))
+        placed.sort(key=lambda n: n[0])
+        
+        sources = dict()
+        for v in self.hg.brLinks.values():
+            sources.setdefault(v[1].rev, []).append(v[0].rev)
+        
+        lanePitch = max([n[3][1] for n in placed] or [0]) + SvgGraph.laneGap
+        left      = SvgGraph.margin + max([len(b) for b, color in lanes] or [0]) * SvgGraph.charWidth + SvgGraph.columnGap
+        
+        # In revision order, each node is placed right after the previous node of its lane and after the nodes
+        # linked to it, which all come before it.
+        nodes = []
+        positions = dict()
+        laneRight = dict()
+        rights = dict()
+        right = left
+        for key, lane, lines, (w, h), node in placed:
+            rev = node[0].rev
+            x = max([laneRight.get(lane, left)] + [rights[r] for r in sources.get(rev, ()) if r in rights]) + SvgGraph.columnGap
+            x += w / 2
+            y = SvgGraph.margin + lane * lanePitch + lanePitch / 2
+            nodes.append((x, y, w, h, lines, node))
+            positions[rev] = (x, y, w, h)
+            laneRight[lane] = rights[rev] = x + w / 2
+            right = max(right, x + w / 2)
+        
+        self.width  = right + SvgGraph.margin
+        self.height = 2 * SvgGraph.margin + (len(lanes) + 1) * lanePitch
+        self.lanePitch = lanePitch
+        return lanes, nodes, positions
+    
+    def write(self, fileobj, hashes=None):
+        """
+        Write the SVG graph to a text file object. If hashes is a dict, the hash of each branch is added to it. The
+        branches are hashed like the ones of the DOT graph, which is generated for that and thrown away.
+        """
+        if hashes is not None:
+            with open(os.devnull, 'w') as null:
+                GraphViz.write(self, null, hashes)
+        lanes, nodes, positions = self._layout()
+        write = fileobj.write
+        
+        write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        write('<svg xmlns="http://www.w3.org/2000/svg" width="{:.0f}" height="{:.0f}" font-family="Courier" '
+              'font-size="{}">\n'.format(self.width, self.height, SvgGraph.fontSize))
+        write('<rect width="100%" height="100%" fill="#ffffff"/>\n<defs>\n')
+        markers = dict()
+        for color in [color for b, color in lanes] + ["blue"]:
+            if color not in markers:
+                markers[color] = "a{}".format(len(markers))
+                write('<marker id="{}" viewBox="0 0 10 10" refX="10" refY="5" markerWidth="6" markerHeight="6" '
+                      'orient="auto"><path d="M0,0 L10,5 L0,10 z" fill="{}"/></marker>\n'.format(
+                      markers[color], self._svgColor(color)))
+        write('</defs>\n')
+        
+        # The branch lanes
+        for i, (b, color) in enumerate(lanes):
+            y = SvgGraph.margin + i * self.lanePitch + self.lanePitch / 2
+            write('<text x="{}" y="{:.1f}" dominant-baseline="middle">{}</text>\n'.format(SvgGraph.margin, y, escape(b)))
+            l = self.hg.brs[b]
+            for j in range(len(l) - 1):
+                x1, y1, w1, h1 = positions[l[j].rev]
+                x2, y2, w2, h2 = positions[l[j + 1].rev]
+                write('<line x1="{:.1f}" y1="{:.1f}" x2="{:.1f}" y2="{:.1f}" stroke="{}" stroke-width="2" '
+                      'marker-end="url(#{})"/>\n'.format(x1 + w1 / 2, y1, x2 - w2 / 2, y2, self._svgColor(color), markers[color]))
+                hidden = self.hg.collapsed.get((l[j].rev, l[j + 1].rev))
+                if hidden:
+                    write('<text x="{:.1f}" y="{:.1f}" font-size="7" text-anchor="middle">+{}</text>\n'.format(
+                          (x1 + x2) / 2, y1 - 3, hidden))
+        
+        # The merges, branching points, tails and tips
+        for k, v in self.hg.brLinks.items():
+            if v[0].rev not in positions or v[1].rev not in positions:
+                continue
+            x1, y1, w1, h1 = positions[v[0].rev]
+            x2, y2, w2, h2 = positions[v[1].rev]
+            x1, x2 = x1 + w1 / 2, x2 - w2 / 2
+            dx = max((x2 - x1) / 2, 10)
+            write('<path d="M{:.1f},{:.1f} C{:.1f},{:.1f} {:.1f},{:.1f} {:.1f},{:.1f}" fill="none" stroke="blue" '
+                  'stroke-dasharray="4,3" marker-end="url(#{})"/>\n'.format(x1, y1, x1 + dx, y1, x2 - dx, y2, x2, y2, markers["blue"]))
+            write('<text x="{:.1f}" y="{:.1f}" font-size="7" fill="blue" text-anchor="middle">{}</text>\n'.format(
+                  (x1 + x2) / 2, (y1 + y2) / 2 - 2, escape(v[2])))
+        
+        # The nodes
+        for x, y, w, h, lines, (c, type, tagName, shape, style, fillColor, fontColor) in nodes:
+            fill = self._svgColor(fillColor) if "filled" in style else "none"
+            attrs = 'fill="{}" stroke="red"'.format(fill)
+            if shape == "circle":
+                write('<circle cx="{:.1f}" cy="{:.1f}" r="{:.1f}" {}/>\n'.format(x, y, w / 2, attrs))
+            elif shape == "diamond":
+                write('<polygon points="{:.1f},{:.1f} {:.1f},{:.1f} {:.1f},{:.1f} {:.1f},{:.1f}" {}/>\n'.format(
+                      x, y - h / 2, x + w / 2, y, x, y + h / 2, x - w / 2, y, attrs))
+            elif shape in ("ellipse", "oval"):
+                write('<ellipse cx="{:.1f}" cy="{:.1f}" rx="{:.1f}" ry="{:.1f}" {}/>\n'.format(x, y, w / 2, h / 2, attrs))
+            else:
+                rx = 4 if "rounded" in style else 0
+                write('<rect x="{:.1f}" y="{:.1f}" width="{:.1f}" height="{:.1f}" rx="{}" {}/>\n'.format(
+                      x - w / 2, y - h / 2, w, h, rx, attrs))
+            
+            top = y - (len(lines) - 1) * SvgGraph.lineHeight / 2
+            write('<text text-anchor="middle" dominant-baseline="middle" fill="{}">'.format(self._svgColor(fontColor)))
+            for i, l in enumerate(lines):
+                write('<tspan x="{:.1f}" y="{:.1f}">{}</tspan>'.format(x, top + i * SvgGraph.lineHeight, escape(l)))
+            write('</text>\n')
+        
+        write('</svg>\n')
+
 
-# In[71]:
+# In[75]:
 
 
 """
@@ -744,9 +2960,13 @@ The main program
 hggraph_yaml = """---
 # hggraph configuraions
 
-# The output DOT Graphviz file
+# The output DOT Graphviz file. It is gzip compressed if the name ends with .gz.
 graphviz: "./graphviz.gv"
 
+# How the graph is written to the graphviz file: "dot" writes a Graphviz DOT file. "svg" lays the graph out with one
+# lane per branch and writes an SVG image directly, which is much faster for big graphs and doesn't need Graphviz.
+renderer: "dot"
+
 # Specify if hggraph needs to retrieve the change set information from the repository directory.
 # Yes - needs to read repository directly. The variable "repo" must be specified.
 # No  - hggraph will read change sets from a file specified by variable "csetFile".
@@ -756,17 +2976,81 @@ retrieveChangeSets: Yes
 # This must be replaced with a correct full directory path of the local Mercurial repository.
 repo: "please_replace_repo"
 
+# How hg commands are run: "process" starts hg for each command. "cmdserver" keeps one Mercurial command server
+# (hg serve --cmdserver pipe) running and sends all the commands to it.
+hgBackend: "process"
+
+# Parse the change sets while hg log outputs them and build the graph at the same time instead of waiting for hg to
+# finish. The output of hg isn't kept in memory. It doesn't apply when csetCacheDir is set.
+streamHgLog: No
+
+# The hg log queries of a graph run concurrently, e.g. the query and the prefetch of the change sets in other
+# branches, the queries of an hgquery listing several branch regexes (hgquery: [".+15R3.*", ".+15R6.*"]) or the
+# windows of the batch jobs on a repository. hgConcurrency is the maximum number of hg processes at a time.
+# A query running longer than hgTimeout seconds is stopped and fails. 0 means no timeout. Neither applies to the
+# command server backend, which runs one command at a time, nor to streamHgLog.
+hgConcurrency: 4
+hgTimeout: 0
+
+# The maximum number of change sets kept in memory by the CSet cache. The least recently used ones are evicted first.
+# 0 means no limit.
+memoryCacheSize: 0
+
+# A directory to keep the change sets of the repository between runs. Only the change sets committed since the
+# previous run are retrieved from the repository. Leave it empty to disable the cache.
+csetCacheDir: ""
+
+# Render the DOT file to an image with Graphviz after it is generated, e.g. "png" or "svg". The image is written next
+# to the DOT file with its render key in <image>.key, and it's kept as long as the DOT file, the command and the
+# options are the same. Empty means no rendering.
+renderFormat: ""
+# The Graphviz command and its extra options, e.g. ["-Gdpi=150"]
+renderCommand: "dot"
+renderOptions: []
+# A directory to keep the rendered images between runs. An image is rendered again only if the DOT file, the command
+# or the options have changed. The least recently used images are removed once they take more than renderCacheSize
+# megabytes. Leave it empty to disable the cache.
+renderCacheDir: ""
+renderCacheSize: 512
+
+# Print the wall time of each stage of the run and counters like hg processes spawned, records parsed, cache hits
+# and misses and bytes written. The same statistics are written as JSON to statsFile if set. --stats turns it on too.
+stats: No
+statsFile: "./hggraph_stats.json"
+
 # The Change Set (CSET) file must be produced by the following command:
 # hg log -r "branch('re:JPMC_15R2.+') or branch('re:JPMC_15R3.+') or branch('re:JPMC_15R6.+')" \
 --template '"branch":"{branch}","children":"{children}",\
 "user":"{author}","date":"{date|isodate}","message":"{firstline(desc)}",\
 "tags":"{tags}","rev":"{rev}","node":"{node}","p1node":"{p1node}",\
 "p1rev":"{p1rev}","p2node":"{p2node}","p2rev":"{p2rev}"\\n'
+# It can also be a binary snapshot converted from it with "python hggraph.py --snapshot FILE", which is
+# memory-mapped and loaded without parsing.
 csetFile: "./repocsets.txt"
 
+# Memory-map the csetFile and stream change sets from it instead of loading the whole file. Recommended for
+# very large files.
+streamCsetFile: No
+
+# The number of processes parsing the csetFile. A big file is split into chunks at line boundaries which are parsed
+# in parallel, the graph is the same. 1 parses it in this process, 0 starts one process per CPU. It doesn't apply
+# when streamCsetFile is on or the csetFile is a snapshot.
+parseWorkers: 1
+
 # The query used by hg command, like hg log -r "branch('re:<hgquery>')"
 hgquery: ".+15R3.*"
 
+# Narrow the query down to a window of the history so that hg only outputs the change sets we need. Empty means no
+# limit. They only apply when retrieveChangeSets is No. They can also be given on the command line, see
+# python hggraph.py --help.
+# sinceDate, untilDate: dates in any format hg accepts, e.g. "2015-06-01"
+# revRange:             a revision range or any revset, e.g. "30000:" or "30000:30500"
+# sinceTag:             only the change sets committed since the tag
+sinceDate: ""
+untilDate: ""
+revRange: ""
+sinceTag: ""
+
 # Regular expression. For long branch name, we should extract part of the branch name so that the graph will be compact.
 # The regular expression must be divided into three groups. The second group will be extracted as the tag name.
 branchNamePattern:  '(\w+_)(\d+.+)(_[a-zA-Z]+)'
@@ -775,6 +3059,18 @@ branchNamePattern:  '(\w+_)(\d+.+)(_[a-zA-Z]+)'
 # The regular expression must be divided into three groups. The second group will be extracted as the tag name.
 tagNamePattern:  '(\w+_)(\d+.+)(_[a-zA-Z]+)'
 
+# Shrink very large graphs so that Graphviz can lay them out in reasonable time. 0 or No disables an option.
+# The main branch is always shown.
+# collapseLinear: hide the change sets which are neither tagged nor linked to another branch in the graph. The branch
+#                 line over them is labelled with the number of change sets it stands for.
+# topBranches:    show only this number of branches with the most change sets.
+# activeDays:     show only the branches with change sets committed in the last activeDays days.
+# dropMergedDays: hide the branches which were merged into another branch more than dropMergedDays days ago.
+collapseLinear: No
+topBranches: 0
+activeDays: 0
+dropMergedDays: 0
+
 # The following are the attributes of various change sets. See graphviz.org for more details.
 subgraphCluster: Yes
 arrange: Yes
@@ -826,33 +3122,402 @@ Check the hggraph.yaml for details.
 ==============================================================================================
 """
 
+def parseWorkers(workers):
+    """
+    The number of processes parsing the csetFile: 0 means one per CPU.
+    """
+    if workers == 0:
+        return len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+    return workers or 1
+
 def runIt(hgProps):
+    stats.reset(bool(hgProps.get("stats")))
+    
+    # The CSet cache shared by the change set source and the graph
+    cache = CSetCache(hgProps.get("memoryCacheSize") or None)
+    
     if hgProps["retrieveChangeSets"]:
         # Retrieve change sets from a file
-        hgCmd = CSetSource(hgProps["csetFile"], hgProps["hgquery"])
+        hgCmd = CSetSource(hgProps["csetFile"], hgProps["hgquery"], hgProps.get("streamCsetFile", False), cache=cache,
+                           workers=parseWorkers(hgProps.get("parseWorkers", 1)))
     else:
         # Runs Mercurial / TortoiseHg command to get all the changes sets based a the query condition.
         hgCmd = HgCommand(
             hgProps["repo"], # The location of the local Mercurial repository
-            hgProps["hgquery"]) # The branch query / filter
-
-    results = hgCmd.run()
-    if not results: # Check if there is any error in the standard error output
+            hgProps["hgquery"], # The branch query / filter
+            cacheDir=hgProps.get("csetCacheDir"),
+            backend=hgProps.get("hgBackend", "process"),
+            since=hgProps.get("sinceDate"),
+            until=hgProps.get("untilDate"),
+            revs=hgProps.get("revRange"),
+            sinceTag=hgProps.get("sinceTag"),
+            cache=cache,
+            streaming=hgProps.get("streamHgLog", False),
+            concurrency=hgProps.get("hgConcurrency", 4),
+            timeout=hgProps.get("hgTimeout"))
+
+    try:
+        with stats.stage("load"):
+            results = hgCmd.run()
+        if not results:
+            exit(1)
+
+        # Now, we build the change sets. In streaming mode hg is still running.
+        hg = HgGraph(hgCmd, cache)
+        with stats.stage("build"):
+            hg.buildChangeSets()
+    except HgCommandError as e:
+        print("\nThere are errors: {}".format(e))
         exit(1)
+    finally:
+        hgCmd.close()
+
+    changed = renderGraph(hg, hgProps)
+    with stats.stage("render"):
+        renderImage(hgProps)
+    reportStats(hgProps, cache)
+    return changed
 
-    # Now, we build the change sets
-    hg = HgGraph(hgCmd)
-    hg.buildChangeSets()
+def reportStats(hgProps, cache):
+    """
+    Print the statistics of the run and write them as JSON to statsFile if they are enabled.
+    """
+    if not stats.enabled:
+        return
+    stats.countCache(cache)
+    report = stats.report()
+    report["graphviz"] = hgProps["graphviz"]
+    print(Stats.summary(report))
+    if hgProps.get("statsFile"):
+        Stats.dump(hgProps["statsFile"], report)
+
+def renderGraph(hg, hgProps):
+    """
+    Summarize the built HgGraph if asked to and write the DOT file. Return the names of the changed branches.
+    """
+    # Shrink the graph if any of the summarization options is set
+    graph = hg
+    summary = dict((k, hgProps.get(k)) for k in ("collapseLinear", "topBranches", "activeDays", "dropMergedDays"))
+    if any(summary.values()):
+        with stats.stage("summarize"):
+            graph = hg.summarize(**dict((k, v or 0) for k, v in summary.items()))
 
     # Now we build the graph and dump it as a string
-    gv = GraphViz(hg, hgProps)
-    dot = gv.dumpGraph()
-    with open(hgProps["graphviz"], 'w', encoding='utf-8') as f:
-             f.write(dot)
+    if hgProps.get("renderer", "dot") == "svg":
+        gv = SvgGraph(graph, hgProps)
+    else:
+        gv = GraphViz(graph, hgProps)
+    kind = gv.format.upper()
+    with stats.stage("write"):
+        changed = gv.dumpGraphIfChanged(hgProps["graphviz"])
+    if gv.written:
+        stats.count("graphBytesWritten", os.path.getsize(hgProps["graphviz"]))
+    
+    if not gv.written:
+        print("Nothing has changed. The {} file {} has not been rewritten.".format(kind, hgProps["graphviz"]))
+        return changed
             
-    print("The DOT file has been generated as {}. You can now run Graphviz dot or gvedit or any Graphviz viewer to see the graph.".format(hgProps["graphviz"]))
+    if kind == "SVG":
+        print("The SVG file has been generated as {}. You can open it with any web browser.".format(hgProps["graphviz"]))
+    else:
+        print("The DOT file has been generated as {}. You can now run Graphviz dot or gvedit or any Graphviz viewer to see the graph.".format(hgProps["graphviz"]))
+    if changed:
+        print("Changed branches: {}".format(", ".join(changed)))
+    return changed
+
+def renderImage(hgProps):
+    """
+    Render the DOT file to an image with Graphviz if renderFormat is set. The RenderCache key of the image is kept in
+    <image>.key, and the image is kept if it was rendered from the same DOT file with the same command and options.
+    With renderCacheDir, the image is taken from the render cache and Graphviz only runs if the DOT file, the
+    command or the options have changed. Return the image file name or None.
+    """
+    imageFormat = hgProps.get("renderFormat")
+    if not imageFormat or hgProps.get("renderer", "dot") != "dot":
+        return None
+    
+    dotFile = hgProps["graphviz"]
+    base = dotFile[:-3] if dotFile.endswith(".gz") else dotFile
+    imageFile = os.path.splitext(base)[0] + "." + imageFormat
+    
+    with GraphViz.openInput(dotFile) as f:
+        source = f.read()
+    
+    command = hgProps.get("renderCommand") or "dot"
+    options = [str(o) for o in hgProps.get("renderOptions") or []]
+    key = RenderCache.key(source, command, imageFormat, options)
+    keyFile = imageFile + ".key"
+    try:
+        with open(keyFile, 'r') as f:
+            oldKey = f.read().strip()
+    except (IOError, OSError):
+        oldKey = None
+    if oldKey == key and os.path.exists(imageFile):
+        print("Nothing has changed. The image {} has not been rendered again.".format(imageFile))
+        return imageFile
+    
+    cache = None
+    if hgProps.get("renderCacheDir"):
+        cache = RenderCache(hgProps["renderCacheDir"], int((hgProps.get("renderCacheSize") or 512) * 1024 * 1024))
+        data = cache.get(key, imageFormat)
+        if data is not None:
+            writeImage(imageFile, data, key)
+            print("The image {} has been taken from the render cache.".format(imageFile))
+            return imageFile
+    
+    try:
+        proc = subprocess.Popen([command, "-T" + imageFormat] + options, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        (data, stderrId) = proc.communicate(source)
+    except OSError as e:
+        print("\nThere are errors running {}: {}".format(command, e))
+        return None
+    if proc.returncode != 0:
+        print("\nThere are errors rendering {}: {}".format(dotFile, stderrId))
+        return None
+    
+    writeImage(imageFile, data, key)
+    if cache:
+        cache.put(key, imageFormat, data)
+    print("The image has been rendered as {}.".format(imageFile))
+    return imageFile
+
+def writeImage(imageFile, data, key):
+    """
+    Write the image and then its key to <image>.key, so that a key is never left next to another image.
+    """
+    with open(imageFile, 'wb') as f:
+        f.write(data)
+    with open(imageFile + ".key", 'w') as f:
+        f.write(key + "\n")
+    stats.count("imageBytesWritten", len(data))
+
+def runRepoJob(job, snapshot, repoCsets, window, cache):
+    """
+    Run one batch job of runRepoJobs. Return the changed branches or None if no change sets match the query.
+    """
+    if snapshot:
+        source = CSetSource(job["csetFile"], job["hgquery"], cache=cache)
+    else:
+        source = SharedCSetSource(repoCsets, job["hgquery"], window, cache)
+    try:
+        with stats.stage("load"):
+            loaded = source.run()
+        if not loaded:
+            print("\nNo change sets match {} for {}".format(job["hgquery"], job["graphviz"]))
+            return None
+        
+        hg = HgGraph(source, cache)
+        with stats.stage("build"):
+            hg.buildChangeSets()
+    finally:
+        source.close()
+    
+    changed = renderGraph(hg, job)
+    with stats.stage("render"):
+        renderImage(job)
+    return changed
+
+def runRepoJobs(repoJobs):
+    """
+    Run the batch jobs on one repository in a worker process. The change sets of the repository are retrieved and
+    indexed once and shared by all the jobs. Return a tuple of a list of (graphviz file, changed branches), where
+    changed branches is None if the job failed, and the statistics report of the jobs.
+    """
+    first = repoJobs[0]
+    cache = CSetCache(first.get("memoryCacheSize") or None)
+    stats.reset(bool(first.get("stats")))
+    
+    # A snapshot is mapped by each job instead, the pages of the map are shared anyway
+    snapshot = first["retrieveChangeSets"] and CSetSnapshot.isSnapshot(first["csetFile"])
+    
+    with stats.stage("load"):
+        if snapshot:
+            lines = None
+        elif first["retrieveChangeSets"]:
+            try:
+                with open(first["csetFile"], 'r') as f:
+                    lines = [l for l in f.read().strip().split("\n") if l]
+            except (IOError, OSError) as e:
+                print("\nThere are errors opening file {}: {}".format(first["csetFile"], e))
+                lines = None
+        else:
+            hgCmd = HgCommand(first["repo"], ".*", cacheDir=first.get("csetCacheDir"), backend=first.get("hgBackend", "process"),
+                              timeout=first.get("hgTimeout"))
+            try:
+                lines = hgCmd.allLines()
+            except HgCommandError as e:
+                print("\nThere are errors: {}".format(e))
+                lines = None
+            finally:
+                hgCmd.close()
+    if not snapshot and not lines:
+        print("\nNo change sets could be loaded for {}".format(first["csetFile"] if first["retrieveChangeSets"] else first["repo"]))
+        report = stats.report()
+        report["graphviz"] = [job["graphviz"] for job in repoJobs]
+        return [(job["graphviz"], None) for job in repoJobs], report
+    repoCsets = RepoCSets(lines) if not snapshot else None
+    
+    # The revisions in the window of each windowed job. The queries run concurrently.
+    windowed = [job for job in repoJobs if not job["retrieveChangeSets"] and
+                any(job.get(k) for k in ("sinceDate", "untilDate", "revRange", "sinceTag"))]
+    queries = [(job["repo"], HgCommand.buildQuery(job["hgquery"], job.get("sinceDate"), job.get("untilDate"),
+                                                  job.get("revRange"), job.get("sinceTag")), "{rev}\n") for job in windowed]
+    with stats.stage("load"):
+        output = HgQueryRunner(first.get("hgConcurrency", 4), first.get("hgTimeout")).run(queries) if queries else []
+    windows = dict(zip([job["graphviz"] for job in windowed], output))
+    
+    results = []
+    for job in repoJobs:
+        window = windows.get(job["graphviz"])
+        if isinstance(window, HgCommandError):
+            print("\nThere are errors: {}".format(window))
+            results.append((job["graphviz"], None))
+            continue
+        if window is not None:
+            window = set(int(r) for r in window.split())
+        
+        # A failing job, e.g. one whose graphviz file can't be written, mustn't stop the other jobs
+        try:
+            results.append((job["graphviz"], runRepoJob(job, snapshot, repoCsets, window, cache)))
+        except (IOError, OSError, HgCommandError) as e:
+            print("\nThere are errors in the job of {}: {}".format(job["graphviz"], e))
+            results.append((job["graphviz"], None))
+    
+    stats.countCache(cache)
+    report = stats.report()
+    report["graphviz"] = [job["graphviz"] for job in repoJobs]
+    return results, report
+
+def runBatch(hgProps, manifestFile, workers=None):
+    """
+    Run the jobs listed in the manifest file. The manifest is a YAML file with a list of jobs, each of which overrides
+    some of hgProps, usually repo or csetFile, hgquery and graphviz:
+    
+        jobs:
+          - repo: /repos/xyz
+            hgquery: ".+15R3.*"
+            graphviz: ./xyz_15R3.gv
+    
+    The jobs on the same repository run in one worker process and share its change sets. The repositories are
+    processed in parallel by a pool of workers, one per CPU by default. Return a list of (graphviz file, changed
+    branches) in manifest order.
+    """
+    with open(manifestFile, 'r') as f:
+        manifest = yaml.safe_load(f)
+    
+    jobs = []
+    byRepo = collections.OrderedDict()
+    for job in manifest.get("jobs") or []:
+        props = dict(hgProps)
+        props.update(job)
+        jobs.append(props)
+        key = ("file", os.path.abspath(props["csetFile"])) if props["retrieveChangeSets"] else ("repo", os.path.abspath(props["repo"]))
+        byRepo.setdefault(key, []).append(props)
+    
+    if not byRepo:
+        print("\nThere are no jobs in {}".format(manifestFile))
+        return []
+    
+    if not workers:
+        workers = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+    with multiprocessing.Pool(min(workers, len(byRepo))) as pool:
+        done = dict()
+        reports = []
+        for results, report in pool.imap_unordered(runRepoJobs, list(byRepo.values())):
+            done.update(results)
+            reports.append(report)
+    
+    results = [(job["graphviz"], done.get(job["graphviz"])) for job in jobs]
+    failed = [g for g, changed in results if changed is None]
+    print("\n{} jobs on {} repositories, {} failed{}".format(len(results), len(byRepo), len(failed),
+                                                          ": " + ", ".join(failed) if failed else ""))
+    
+    # The statistics are collected per repository by the workers
+    if hgProps.get("stats"):
+        for report in reports:
+            print(Stats.summary(report, "Statistics of {}:".format(", ".join(report["graphviz"]))))
+        if hgProps.get("statsFile"):
+            Stats.dump(hgProps["statsFile"], {"repositories": reports})
+    return results
+
+def writeSnapshot(hgProps, fileName):
+    """
+    Convert all the change sets of csetFile, or of the repository if retrieveChangeSets is off, to a binary
+    snapshot in fileName, see CSetSnapshot. Point csetFile to the snapshot to load it without parsing.
+    Return the number of change sets written or False if there was an error.
+    """
+    if hgProps["retrieveChangeSets"]:
+        if CSetSnapshot.isSnapshot(hgProps["csetFile"]):
+            print("\n{} is a snapshot already".format(hgProps["csetFile"]))
+            return False
+        with open(hgProps["csetFile"], 'r', encoding='utf-8') as f:
+            lines = [l.strip() for l in f if l.strip()]
+    else:
+        hgCmd = HgCommand(hgProps["repo"], ".*", cacheDir=hgProps.get("csetCacheDir"), backend=hgProps.get("hgBackend", "process"),
+                          timeout=hgProps.get("hgTimeout"))
+        try:
+            lines = hgCmd.allLines()
+        except HgCommandError as e:
+            print("\nThere are errors: {}".format(e))
+            return False
+        finally:
+            hgCmd.close()
+    if not lines:
+        print("\nNo change sets could be loaded for {}".format(hgProps["csetFile"] if hgProps["retrieveChangeSets"] else hgProps["repo"]))
+        return False
+    
+    count = CSetSnapshot.write(lines, fileName)
+    snapshot = CSetSnapshot(fileName)
+    if not snapshot.open():
+        return False
+    snapshot.close()
+    print("{} change sets have been written to {}".format(count, fileName))
+    return count
+
+usage = """
+Usage: python hggraph.py [options]
+
+The options override the ones in ./hggraph.yaml. They narrow down the change sets retrieved from the repository:
+    --since DATE      only the change sets committed on or after DATE, e.g. 2015-06-01
+    --until DATE      only the change sets committed on or before DATE
+    --revs REVSET     only the change sets in the revision range, e.g. 30000: or 30000:30500
+    --since-tag TAG   only the change sets committed since the tag TAG
+
+Batch mode generates the graphs of all the jobs in a manifest file, see runBatch:
+    --batch FILE      the YAML manifest listing the jobs
+    --workers N       the number of worker processes, one per CPU by default
+
+    --snapshot FILE   convert the change sets of csetFile, or of the repository, to the binary snapshot FILE.
+                      Setting csetFile to FILE loads the change sets from the snapshot without parsing them.
+
+    --stats           print the time spent in each stage and the counters of the run, see statsFile
+"""
 
 def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "h", ["help", "since=", "until=", "revs=", "since-tag=", "batch=", "workers=", "stats", "snapshot="])
+    except getopt.GetoptError as e:
+        print("{}\n{}".format(e, usage))
+        return
+    
+    options = dict()
+    batch, workers, snapshot = None, None, None
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            print(usage)
+            return
+        if o == "--batch":
+            batch = a
+        elif o == "--workers":
+            workers = int(a)
+        elif o == "--snapshot":
+            snapshot = a
+        elif o == "--stats":
+            options["stats"] = True
+        else:
+            options[{"--since": "sinceDate", "--until": "untilDate", "--revs": "revRange", "--since-tag": "sinceTag"}[o]] = a
+    
     generatedNewHggraphYaml = False
     if not os.path.exists("./hggraph.yaml"):
         generatedNewHggraphYaml = True
@@ -860,19 +3525,23 @@ def main():
              f.write(hggraph_yaml)
 
     with open("./hggraph.yaml", 'r') as f:
-        hgCfg = yaml.load(f)
+        hgCfg = yaml.safe_load(f)
+    hgCfg.update(options)
 
     if generatedNewHggraphYaml:
         print(info.format(hgCfg["retrieveChangeSets"], hgCfg["csetFile"], hgCfg["repo"]))
 
-    if not hgCfg["retrieveChangeSets"] and hgCfg["repo"] == "please_replace_repo":
+    if batch:
+        runBatch(hgCfg, batch, workers)
+    elif not hgCfg["retrieveChangeSets"] and hgCfg["repo"] == "please_replace_repo":
         print("Please make sure you change 'repo' to the correct location of local Mercurial repository and run the application again.")
+    elif snapshot:
+        writeSnapshot(hgCfg, snapshot)
     else:
-        pass
         runIt(hgCfg)
 
 
-# In[72]:
+# In[76]:
 
 
 if __name__ == "__main__":
@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Benchmarks for hggraph
+#
+# Measures the throughput of the hggraph pipeline stages. See usage below.
+
+import os
+import sys
+import json
+import time
+import getopt
+import random
+import hashlib
+import tempfile
+import datetime
+import tracemalloc
+from collections import namedtuple
+
+import yaml
+
+import hggraph
+
+
+usage = """
+Usage:
+
+    python hggraph_bench.py parser [csetFile] [number of records]
+        Parse the records of csetFile, repocsets.txt by default, repeated as many times as needed.
+
+    python hggraph_bench.py build [number of change sets ...]
+        Build the graph of a synthetic repository of each size, 100000 and 1000000 change sets by default.
+
+    python hggraph_bench.py generate [options] csetFile
+        Write a synthetic repository to csetFile. Options:
+            --branches N        number of branches, 20 by default
+            --per-branch N      change sets per branch, 1000 by default
+            --merge-density X   probability that a feature branch commit is merged into the main branch, 0.05
+            --tag-every N       tag every N-th main branch commit, 100 by default
+            --seed N            random seed, 1 by default
+
+    python hggraph_bench.py suite [options] [number of change sets ...]
+        Time and memory-profile CSetSource.run, HgGraph.buildChangeSets and GraphViz.dumpGraph on synthetic
+        repositories of each size, 10000, 100000 and 1000000 change sets by default, and compare them with the
+        baseline. The time is the shortest of 3 runs up to 100000 change sets, the memory is the peak traced
+        memory each stage allocates. Exit with 1 if any of them regressed. Options:
+            --baseline FILE     the baseline file, ./hggraph_bench_baseline.json by default
+            --save              save the results as the baseline instead of comparing
+            --tolerance X       allowed slowdown over the baseline, 0.5 (50%) by default
+            --memory-tolerance X    allowed memory growth over the baseline, 0.1 (10%) by default
+            --no-memory         skip the memory profile, which runs every stage a second time
+
+    python hggraph_bench.py snapshot [csetFile] [number of change sets ...]
+        Convert csetFile, repocsets.txt by default, to a binary snapshot and check that every change set and the
+        graph read back the same. Then time loading synthetic repositories of each size, 100000 and 1000000
+        change sets by default, from the text file and from the snapshot. Exit with 1 if the round trip fails.
+
+    python hggraph_bench.py cmdserver [csetFile]
+        Check HgCmdServer and the "cmdserver" backend of HgCommand against hggraph_fakecmdserver.py, a fake command
+        server answering with the records of csetFile, repocsets.txt by default. Exit with 1 if a check fails.
+"""
+
+BASELINE_FILE = "./hggraph_bench_baseline.json"
+SUITE_SIZES = [10000, 100000, 1000000]
+SUITE_REPEAT = 3 # Times each stage runs on repositories up to 100000 change sets. The shortest run counts.
+MIN_SLOWDOWN = 0.02 # Seconds. Smaller differences are noise.
+STAGES = ["CSetSource.run", "HgGraph.buildChangeSets", "GraphViz.dumpGraph"]
+
+# The hgquery matching all the branches of a synthetic repository
+SYNTHETIC_QUERY = ".+15R3.*"
+
+def generateCSets(fileName, branches=20, perBranch=1000, mergeDensity=0.05, tagEvery=100, seed=1):
+    """
+    Write a synthetic repository to fileName in the csetFile format.
+
+    There is one main branch and branches - 1 feature branches. The feature branches are opened one after another
+    from the head of the main branch and committed to in turn with it. After a feature branch commit, the main branch
+    merges the feature branch with the probability mergeDensity. Every tagEvery-th main branch commit is tagged.
+    """
+    rnd   = random.Random(seed)
+    total = branches * perBranch
+    main  = "XYZ_15R3.x_BRANCH"
+    names = [main] + ["feature_XYZ_15R3.x_XYZ15R3-{}_BRANCH".format(i) for i in range(1, branches)]
+    opens = [i * total // (2 * branches) for i in range(branches)]
+    heads = dict()
+    csets = [] # [branch, p1, p2, tags]
+    mainCommits = [0]
+
+    def commit(b, p1, p2=hggraph.HG_NO_PARENT_REV):
+        tags = ""
+        if b == main:
+            mainCommits[0] += 1
+            if mainCommits[0] % tagEvery == 0:
+                tags = "XYZ_15R3.{}_REL".format(mainCommits[0] // tagEvery)
+        heads[b] = len(csets)
+        csets.append((b, p1, p2, tags))
+
+    while len(csets) < total:
+        active = [b for i, b in enumerate(names) if opens[i] <= len(csets)]
+        b = active[len(csets) % len(active)]
+        commit(b, heads.get(b, heads.get(main, hggraph.HG_NO_PARENT_REV)))
+        if b != main and rnd.random() < mergeDensity:
+            commit(main, heads[main], heads[b])
+
+    children = [[] for c in csets]
+    for rev, c in enumerate(csets):
+        for p in c[1:3]:
+            if p != hggraph.HG_NO_PARENT_REV:
+                children[p].append(rev)
+
+    node  = lambda rev: hashlib.sha1(str(rev).encode("ascii")).hexdigest() if rev >= 0 else "0" * 40
+    start = datetime.datetime(2015, 1, 1)
+    with open(fileName, 'w', encoding='utf-8') as f:
+        for rev, (b, p1, p2, tags) in enumerate(csets):
+            f.write('"branch":"{}","children":"{}","user":"someone","date":"{} -0400","message":"some messages",'
+                    '"tags":"{}","rev":"{}","node":"{}","p1node":"{}","p1rev":"{}","p2node":"{}","p2rev":"{}"\n'.format(
+                    b, " ".join("{}:{}".format(c, node(c)[:12]) for c in children[rev]),
+                    (start + datetime.timedelta(minutes=rev)).strftime("%Y-%m-%d %H:%M"),
+                    tags, rev, node(rev), node(p1), p1, node(p2), p2))
+    return len(csets)
+
+def loadRecords(fileName, count):
+    with open(fileName, 'r') as f:
+        lines = [l.strip() for l in f if l.strip()]
+    return (lines * (count // len(lines) + 1))[:count]
+
+def timeIt(func, records):
+    """
+    Run func over all the records and return the number of records per second.
+    """
+    start = time.perf_counter()
+    for r in records:
+        func(r)
+    return len(records) / (time.perf_counter() - start)
+
+def parseWithJson(record):
+    """The parser used before CSetParser: json.loads building a namedtuple class per record."""
+    return json.loads("{" + record + "}", object_hook=lambda d: namedtuple('CSet', d.keys())(*d.values()))
+
+def benchParser(records):
+    old = timeIt(parseWithJson, records)
+    new = timeIt(hggraph.CSetParser.parse, records)
+    print("Parsing {} records:".format(len(records)))
+    print("\tjson.loads + namedtuple: {:>12,.0f} records/s".format(old))
+    print("\tCSetParser.parse:        {:>12,.0f} records/s".format(new))
+    print("\tspeedup:                 {:>12.1f}x".format(new / old))
+
+def runStages(fileName, timings, trace=False):
+    """
+    Run the pipeline stages over fileName. Store the duration in seconds of each stage in timings, keeping the
+    shortest one if there is one already, or the peak memory in bytes the stage allocated if trace is True.
+    """
+    def measure(stage, func):
+        if trace:
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            func()
+            timings[stage] = tracemalloc.get_traced_memory()[1] - before
+        else:
+            start = time.perf_counter()
+            func()
+            timings[stage] = min(time.perf_counter() - start, timings.get(stage, float("inf")))
+    
+    if trace:
+        tracemalloc.start()
+    try:
+        src = hggraph.CSetSource(fileName, SYNTHETIC_QUERY)
+        measure(STAGES[0], src.run)
+        hg = hggraph.HgGraph(src)
+        measure(STAGES[1], hg.buildChangeSets)
+        gv = hggraph.GraphViz(hg, yaml.safe_load(hggraph.hggraph_yaml))
+        measure(STAGES[2], gv.dumpGraph)
+    finally:
+        if trace:
+            tracemalloc.stop()
+
+def benchSuite(sizes, baselineFile, save=False, tolerance=0.5, memoryTolerance=0.1, memory=True):
+    """
+    Run the stages on a synthetic repository of each size. Save the results to baselineFile or compare them with it.
+    Return False if a stage regressed, i.e. took more time than the baseline plus tolerance or more memory than the
+    baseline plus memoryTolerance. Timings are noisy, the memory profile isn't.
+    """
+    results = dict()
+    for count in sizes:
+        fd, fileName = tempfile.mkstemp(suffix=".txt")
+        os.close(fd)
+        try:
+            generateCSets(fileName, branches=50, perBranch=count // 50)
+            seconds, peaks = dict(), dict()
+            for i in range(SUITE_REPEAT if count <= 100000 else 1):
+                runStages(fileName, seconds)
+            if memory:
+                runStages(fileName, peaks, trace=True)
+        finally:
+            os.remove(fileName)
+        results[str(count)] = dict((stage, {"seconds": seconds[stage], "peakBytes": peaks.get(stage)}) for stage in STAGES)
+    
+    baseline = dict()
+    if not save and os.path.exists(baselineFile):
+        with open(baselineFile, 'r') as f:
+            baseline = json.load(f)
+    
+    ok = True
+    print("{:>10} {:<24} {:>9} {:>9} {:>12} {:>12}".format("csets", "stage", "seconds", "baseline", "peak MB", "baseline"))
+    for count in sizes:
+        for stage in STAGES:
+            now  = results[str(count)][stage]
+            base = baseline.get(str(count), {}).get(stage, {})
+            flags = []
+            for metric in ("seconds", "peakBytes"):
+                allowed = tolerance if metric == "seconds" else memoryTolerance
+                if now[metric] is None or not base.get(metric) or now[metric] <= base[metric] * (1 + allowed):
+                    continue
+                if metric == "seconds" and now[metric] - base[metric] < MIN_SLOWDOWN:
+                    continue
+                flags.append("slower" if metric == "seconds" else "more memory")
+            ok = ok and not flags
+            mb = lambda b: "{:.1f}".format(b / 1e6) if b is not None else "-"
+            sec = lambda s: "{:.2f}".format(s) if s is not None else "-"
+            print("{:>10,} {:<24} {:>9} {:>9} {:>12} {:>12} {}".format(count, stage, sec(now["seconds"]),
+                  sec(base.get("seconds")), mb(now["peakBytes"]), mb(base.get("peakBytes")),
+                  "REGRESSION: " + ", ".join(flags) if flags else ""))
+    
+    if save:
+        baseline = dict()
+        if os.path.exists(baselineFile):
+            with open(baselineFile, 'r') as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(baselineFile, 'w') as f:
+            json.dump(baseline, f, indent=1, sort_keys=True)
+        print("The baseline has been saved to {}".format(baselineFile))
+    return ok
+
+def benchBuild(count):
+    """
+    Time loading and building the graph of a synthetic repository with count change sets.
+    """
+    fd, fileName = tempfile.mkstemp(suffix=".txt")
+    os.close(fd)
+    try:
+        generateCSets(fileName, branches=50, perBranch=count // 50)
+
+        start = time.perf_counter()
+        src = hggraph.CSetSource(fileName, SYNTHETIC_QUERY)
+        src.run()
+        loaded = time.perf_counter()
+        hg = hggraph.HgGraph(src)
+        hg.buildChangeSets()
+        built = time.perf_counter()
+    finally:
+        os.remove(fileName)
+
+    print("Building the graph of {:,} change sets:".format(count))
+    print("\tCSetSource.run:          {:>8.2f}s".format(loaded - start))
+    print("\tHgGraph.buildChangeSets: {:>8.2f}s".format(built - loaded))
+    print("\t{} branches, {} links".format(len(hg.brs), len(hg.brLinks)))
+
+def dumpSource(src):
+    hg = hggraph.HgGraph(src)
+    hg.buildChangeSets()
+    return hggraph.GraphViz(hg, yaml.safe_load(hggraph.hggraph_yaml)).dumpGraph()
+
+def checkSnapshot(fileName):
+    """
+    Round trip the change sets of fileName through a snapshot. Return the number of differences.
+    """
+    with open(fileName, 'r', encoding='utf-8') as f:
+        lines = [l.strip() for l in f if l.strip()]
+    fd, snapshotFile = tempfile.mkstemp(suffix=".snap")
+    os.close(fd)
+    try:
+        hggraph.CSetSnapshot.write(lines, snapshotFile)
+        snapshot = hggraph.CSetSnapshot(snapshotFile)
+        if not snapshot.open():
+            return len(lines)
+
+        bad = 0
+        if len(snapshot) != len(lines):
+            print("\t{} change sets read back instead of {}".format(len(snapshot), len(lines)))
+            bad += 1
+        for row, l in enumerate(lines):
+            c = hggraph.CSetParser.parse(l)
+            cset = snapshot.cset(row)
+            diff = [f for f in hggraph.CSet.__slots__ if getattr(cset, f) != getattr(c, f)]
+            if snapshot.row(c.rev) is None:
+                diff.append("lookup")
+            if diff:
+                print("\trev {} differs in {}".format(c.rev, ", ".join(diff)))
+                bad += 1
+        snapshot.close()
+
+        graphs = []
+        for name in (fileName, snapshotFile):
+            src = hggraph.CSetSource(name, SYNTHETIC_QUERY)
+            src.run()
+            graphs.append(dumpSource(src))
+            src.close()
+        if graphs[0] != graphs[1]:
+            print("\tthe graphs differ")
+            bad += 1
+    finally:
+        os.remove(snapshotFile)
+    return bad
+
+def checkCmdServer(fileName):
+    """
+    Run commands through HgCmdServer against the fake command server. Return the number of failed checks.
+    """
+    with open(fileName, 'rb') as f:
+        records = f.read()
+    fake = os.path.join(os.path.dirname(os.path.abspath(__file__)), "hggraph_fakecmdserver.py")
+    command = [sys.executable, fake, os.path.abspath(fileName)]
+    log = lambda revset: ["log", "-r", revset, "--template", "{rev}\n"]
+
+    bad = []
+    def check(name, ok):
+        print("\t{:<48} {}".format(name, "OK" if ok else "FAILED"))
+        if not ok:
+            bad.append(name)
+
+    server = hggraph.HgCmdServer(".", command)
+    server.start()
+    check("hello: capabilities and encoding", "runcommand" in server.capabilities and server.encoding == "UTF-8")
+    ret, out, err = server.runCommand(log("all()"))
+    check("runCommand: output split over messages", (ret, out, err) == (0, records, b""))
+    messages = list(server.messages(log("all()")))
+    check("messages: output then result", [c for c, d in messages] == [b"o", b"o", b"r"] and
+          b"".join(d for c, d in messages[:-1]) == records)
+    ret, out, err = server.runCommand(log("bad"))
+    check("runCommand: error channel and return code", ret == 255 and out == b"" and b"unknown revision" in err)
+    ret, out, err = server.runCommand(log("input"))
+    check("runCommand: input request answered", (ret, out) == (0, records))
+    try:
+        server.runCommand(log("required"))
+        check("unknown required channel raises", False)
+    except hggraph.HgCommandError:
+        check("unknown required channel raises", server.proc is None)
+    server.close()
+
+    # The graph built through the command server backend is the one built from the file
+    hgCmd = hggraph.HgCommand(".", SYNTHETIC_QUERY, backend="cmdserver")
+    hgCmd.cmdServer = hggraph.HgCmdServer(".", command)
+    src = hggraph.CSetSource(fileName, SYNTHETIC_QUERY)
+    graphs = []
+    for source in (hgCmd, src):
+        source.run()
+        graphs.append(dumpSource(source))
+        source.close()
+    check("HgCommand backend cmdserver: same graph", graphs[0] == graphs[1])
+    return len(bad)
+
+def benchSnapshot(count):
+    """
+    Time loading a synthetic repository with count change sets from the text file and from its snapshot.
+    """
+    fd, fileName = tempfile.mkstemp(suffix=".txt")
+    os.close(fd)
+    snapshotFile = fileName + ".snap"
+    try:
+        generateCSets(fileName, branches=50, perBranch=count // 50)
+        with open(fileName, 'r', encoding='utf-8') as f:
+            start = time.perf_counter()
+            hggraph.CSetSnapshot.write(f, snapshotFile)
+        converted = time.perf_counter() - start
+
+        timings = []
+        for name in (fileName, snapshotFile):
+            src = hggraph.CSetSource(name, SYNTHETIC_QUERY)
+            start = time.perf_counter()
+            src.run()
+            loaded = time.perf_counter()
+            hg = hggraph.HgGraph(src)
+            hg.buildChangeSets()
+            timings.append((loaded - start, time.perf_counter() - loaded))
+            src.close()
+        sizes = os.path.getsize(fileName), os.path.getsize(snapshotFile)
+    finally:
+        for name in (fileName, snapshotFile):
+            if os.path.exists(name):
+                os.remove(name)
+
+    print("Loading {:,} change sets:".format(count))
+    print("\tconversion to snapshot:  {:>8.2f}s".format(converted))
+    print("\ttext file     {:>7.1f} MB, CSetSource.run {:>8.3f}s, HgGraph.buildChangeSets {:>8.2f}s".format(sizes[0] / 1e6, *timings[0]))
+    print("\tsnapshot      {:>7.1f} MB, CSetSource.run {:>8.3f}s, HgGraph.buildChangeSets {:>8.2f}s".format(sizes[1] / 1e6, *timings[1]))
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "parser"
+
+    if command == "parser":
+        fileName = sys.argv[2] if len(sys.argv) > 2 else "./repocsets.txt"
+        count    = int(sys.argv[3]) if len(sys.argv) > 3 else 100000
+        benchParser(loadRecords(fileName, count))
+    elif command == "build":
+        for count in [int(a) for a in sys.argv[2:]] or [100000, 1000000]:
+            benchBuild(count)
+    elif command == "generate":
+        opts, args = getopt.getopt(sys.argv[2:], "", ["branches=", "per-branch=", "merge-density=", "tag-every=", "seed="])
+        options = dict(opts)
+        if len(args) != 1:
+            print(usage)
+            sys.exit(1)
+        count = generateCSets(args[0],
+                              branches     = int(options.get("--branches", 20)),
+                              perBranch    = int(options.get("--per-branch", 1000)),
+                              mergeDensity = float(options.get("--merge-density", 0.05)),
+                              tagEvery     = int(options.get("--tag-every", 100)),
+                              seed         = int(options.get("--seed", 1)))
+        print("{:,} change sets have been written to {}".format(count, args[0]))
+    elif command == "suite":
+        opts, args = getopt.getopt(sys.argv[2:], "", ["baseline=", "save", "tolerance=", "memory-tolerance=", "no-memory"])
+        options = dict(opts)
+        ok = benchSuite([int(a) for a in args] or SUITE_SIZES,
+                        options.get("--baseline", BASELINE_FILE),
+                        save      = "--save" in options,
+                        tolerance = float(options.get("--tolerance", 0.5)),
+                        memoryTolerance = float(options.get("--memory-tolerance", 0.1)),
+                        memory    = "--no-memory" not in options)
+        sys.exit(0 if ok else 1)
+    elif command == "snapshot":
+        args = sys.argv[2:]
+        fileName = args.pop(0) if args and not args[0].isdigit() else "./repocsets.txt"
+        bad = checkSnapshot(fileName)
+        print("Round trip of {} through a snapshot: {}".format(fileName, "{} differences".format(bad) if bad else "OK"))
+        if bad:
+            sys.exit(1)
+        for count in [int(a) for a in args] or [100000, 1000000]:
+            benchSnapshot(count)
+    elif command == "cmdserver":
+        fileName = sys.argv[2] if len(sys.argv) > 2 else "./repocsets.txt"
+        print("Checking HgCmdServer against a fake command server:")
+        bad = checkCmdServer(fileName)
+        print("{} checks failed".format(bad) if bad else "All the checks passed")
+        if bad:
+            sys.exit(1)
+    else:
+        print(usage)
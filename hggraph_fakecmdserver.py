@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Fake Mercurial command server
+#
+# Speaks the framing of hg serve --cmdserver pipe on stdin and stdout so that HgCmdServer can be checked without
+# Mercurial, see "python hggraph_bench.py cmdserver". Every runcommand answers with the records of csetFile,
+# repocsets.txt by default, split over two output messages, except for these revsets (the -r argument):
+#
+#     bad         an error message and return code 255
+#     input       an input request first, which the client has to answer
+#     required    a message on the unknown required channel 'X'
+#
+# Usage: python hggraph_fakecmdserver.py [csetFile]
+
+import sys
+import struct
+
+
+def send(channel, data):
+    sys.stdout.buffer.write(channel + struct.pack(">I", len(data)) + data)
+    sys.stdout.buffer.flush()
+
+def serve(records):
+    send(b"o", b"capabilities: getencoding runcommand\nencoding: UTF-8\npid: 0")
+    stdin = sys.stdin.buffer
+    while True:
+        command = stdin.readline()
+        if not command:
+            return
+        length = struct.unpack(">I", stdin.read(4))[0]
+        args = stdin.read(length).split(b"\0")
+        if command != b"runcommand\n":
+            send(b"e", b"unknown command " + command.strip())
+            send(b"r", struct.pack(">i", 255))
+            continue
+
+        revset = args[args.index(b"-r") + 1] if b"-r" in args else b""
+        send(b"d", b"debug messages are ignored by the client")
+        if revset == b"bad":
+            send(b"e", b"abort: unknown revision 'bad'!\n")
+            send(b"r", struct.pack(">i", 255))
+        elif revset == b"required":
+            send(b"X", b"")
+        else:
+            if revset == b"input":
+                sys.stdout.buffer.write(b"I" + struct.pack(">I", 4096))
+                sys.stdout.buffer.flush()
+                size = struct.unpack(">I", stdin.read(4))[0]
+                stdin.read(size)
+            half = len(records) // 2
+            send(b"o", records[:half])
+            send(b"o", records[half:])
+            send(b"r", struct.pack(">i", 0))
+
+
+if __name__ == "__main__":
+    with open(sys.argv[1] if len(sys.argv) > 1 else "./repocsets.txt", 'rb') as f:
+        serve(f.read())